@@ -24,34 +24,1222 @@
 #                                                                              #
 ################################################################################
 
-import cobra.mit.access
-import cobra.mit.session
-import cobra.mit.request
-import cobra.model.config
-import cobra.model.fabric
-import cobra.model.pol
+import time
+STARTED = time.time()
+
+# Cobra is imported by the commands which need it, it takes a while to load
 import requests
 import re
 import sys
-import datetime
+import csv
+import json
+import argparse
+import os
+import sqlite3
+import socket
+import SocketServer
+import cProfile
+import pstats
+import ssl
+import threading
+import Queue
+from bisect import bisect_left
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
+from functools import wraps
 from requests.packages.urllib3.exceptions import InsecureRequestWarning, InsecurePlatformWarning, SNIMissingWarning
 from cmd import Cmd
 from operator import attrgetter
+from StringIO import StringIO
 from getpass import getpass
 from prettytable import PrettyTable
 
+try:
+    import websocket
+except ImportError:
+    # optional, only the watch command needs websocket-client
+    websocket = None
+
+try:
+    # optional, decodes large query responses several times faster than json
+    import ujson
+    json_loads = ujson.loads
+except ImportError:
+    json_loads = json.loads
+
 
 try:
+    from settings import aci_settings
     from settings.aci_settings import FABRICS
 except:
     sys.exit('ERROR: Missing or incorrect aci_settings.py file.')
 
+QUERY_CONCURRENCY = getattr(aci_settings, 'QUERY_CONCURRENCY', 4)
+CACHE_TTL = {'infraRtAccPortP': 600, 'infraNodeBlk': 600, 'infraHPortS': 600, 'fvnsVlanInstP': 600,
+             'fabricNode': 600, 'fvAEPg': 120, 'l1PhysIf': 60, 'ethpmPhysIf': 10, 'configSnapshot': 0, 'aaaModLR': 0}
+CACHE_TTL.update(getattr(aci_settings, 'CACHE_TTL', {}))
+CACHE_DEFAULT_TTL = getattr(aci_settings, 'CACHE_DEFAULT_TTL', 30)
+CACHE_MAX_MOS = getattr(aci_settings, 'CACHE_MAX_MOS', 500000)
+PAGE_SIZE = getattr(aci_settings, 'PAGE_SIZE', 5000)
+DN_CACHE_SIZE = 100000
+APIC_TIMEOUT = getattr(aci_settings, 'APIC_TIMEOUT', 30)
+REST_READS = getattr(aci_settings, 'REST_READS', True)
+DAEMON_SOCKET = os.path.expanduser(getattr(aci_settings, 'DAEMON_SOCKET', '~/.acli/acli.sock'))
+COMPLETIONS_DIR = os.path.expanduser(getattr(aci_settings, 'COMPLETIONS_DIR', '~/.acli'))
+# saved EPG names are refreshed from the audit log, and downloaded again once a day
+COMPLETIONS_MAX_AGE = 86400
+AUDIT_PAGE_SIZE = 1000
+
 SHOW_CMDS = ['epg', 'interface', 'vlan', 'snapshot']
 SHOW_EPG_CMDS = ['NAME', 'all|ALL']
-SHOW_VLAN_CMDS = ['pools', '<vlan_id>']
+SHOW_VLAN_CMDS = ['pools', '<vlan_id>', '<from>-<to>', 'free', 'overlap']
 SHOW_INTF_CMDS = ['<node>', ]
 CONFIG_CMDS = ['snapshot', ]
 CONFIG_SNAPSHOT = ['<snapshot_id>', 'new']
+CACHE_CMDS = ['stats', 'clear']
+WATCH_CMDS = ['epg', 'interface']
+STATS_CMDS = ['queries', 'export', 'clear']
+STATS_FORMATS = ['json', 'trace']
+PROFILE_LINES = 30
+OUTPUT_FORMATS = ['table', 'json', 'csv', 'ndjson']
+DAEMON_CMDS = ['show', 'stats']
+
+# child classes the collectors use, everything else is filtered out by the APIC
+EPG_CHILDREN = 'fvRsPathAtt,fvRsBd,tagInst'
+PORT_SELECTOR_CHILDREN = 'infraRsAccBaseGrp,infraPortBlk,infraSubPortBlk'
+VLAN_POOL_CHILDREN = 'fvnsEncapBlk,fvnsRtVlanNs'
+# classes watch subscribes to and the cached class their changes make stale
+WATCH_CACHED_CLASSES = {'ethpmPhysIf': 'ethpmPhysIf', 'fvRsPathAtt': 'fvAEPg'}
+SUBSCRIPTION_REFRESH = 30
+# access policy classes the port selector map is built from
+INFRA_CONFIG_CLASSES = ['infraRtAccPortP', 'infraNodeBlk', 'infraHPortS']
+
+
+def eq_filter(class_name, prop, value):
+    return 'eq({0}.{1},"{2}")'.format(class_name, prop, value)
+
+
+def and_filter(*filters):
+    return filters[0] if len(filters) == 1 else 'and({0})'.format(','.join(filters))
+
+
+def or_filter(*filters):
+    return filters[0] if len(filters) == 1 else 'or({0})'.format(','.join(filters))
+
+
+def epg_filter(epg):
+    """fvAEPg filter for an EPG name, which can be qualified as TENANT/EPG or TENANT/AP/EPG"""
+    names = epg.split('/')
+    if len(names) == 3:
+        return eq_filter('fvAEPg', 'dn', 'uni/tn-{0}/ap-{1}/epg-{2}'.format(*names))
+    name_filter = eq_filter('fvAEPg', 'name', names[-1])
+    if len(names) == 2:
+        return and_filter(name_filter, 'wcard(fvAEPg.dn,"uni/tn-{0}/")'.format(names[0]))
+    return name_filter
+
+
+def is_auth_error(error):
+    return getattr(error, 'httpCode', None) in (401, 403) or str(getattr(error, 'error', '')) in ('401', '403')
+
+
+def is_connection_error(error):
+    return isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+
+
+def submit(func, *args, **kwargs):
+    """Starts func in a background thread and returns a function which waits for its result."""
+    result = {}
+    # in the daemon, what the thread prints goes to the client of the thread starting it
+    outputs = [(output, output.current()) for output in (sys.stdout, sys.stderr) if isinstance(output, ThreadOutput)]
+
+    def worker():
+        for output, stream in outputs:
+            output.redirect(stream)
+        try:
+            result['value'] = func(*args, **kwargs)
+        except Exception as error:
+            result['error'] = error
+
+    thread = threading.Thread(target=worker)
+    thread.daemon = True
+    thread.start()
+
+    def wait():
+        # join with a timeout so Ctrl-C still reaches the main thread
+        while thread.is_alive():
+            thread.join(0.1)
+        if 'error' in result:
+            raise result['error']
+        return result['value']
+
+    return wait
+
+
+def run_parallel(calls):
+    """Runs (function, args, kwargs) calls in parallel threads and returns their results in order."""
+    waits = [submit(func, *args, **kwargs) for func, args, kwargs in calls]
+    return [wait() for wait in waits]
+
+
+class Timing(object):
+    """Durations of the APIC queries and the collect and render phases of the last commands."""
+
+    def __init__(self, keep=20):
+        self.keep = keep
+        self.commands = []
+        self.current = None
+        self.lock = threading.Lock()
+
+    def begin(self, line, start=None):
+        self.current = {'command': line, 'start': start or time.time(), 'duration': 0, 'spans': []}
+
+    def end(self):
+        with self.lock:
+            command, self.current = self.current, None
+            if command is not None:
+                command['duration'] = time.time() - command['start']
+                self.commands = self.commands[-(self.keep - 1):] + [command]
+        return command
+
+    @contextmanager
+    def span(self, category, name, **args):
+        """Records the time spent in the with block, values added to the yielded dict are stored with it"""
+        start = time.time()
+        try:
+            yield args
+        finally:
+            self.record(category, name, start, time.time() - start, **args)
+
+    def record(self, category, name, start, duration, **args):
+        with self.lock:
+            if self.current is not None:
+                self.current['spans'].append({'category': category, 'name': name, 'start': start,
+                                              'duration': duration, 'thread': threading.current_thread().name,
+                                              'args': args})
+
+    def trace_events(self):
+        """The recorded commands as Chrome trace events, for chrome://tracing or Perfetto"""
+        events = []
+        threads = {}
+        for command in self.commands:
+            events.append({'name': command['command'], 'cat': 'command', 'ph': 'X', 'pid': 1, 'tid': 0,
+                           'ts': int(command['start'] * 1e6), 'dur': int(command['duration'] * 1e6)})
+            for span in command['spans']:
+                tid = threads.setdefault(span['thread'], len(threads) + 1)
+                events.append({'name': span['name'], 'cat': span['category'], 'ph': 'X', 'pid': 1, 'tid': tid,
+                               'ts': int(span['start'] * 1e6), 'dur': int(span['duration'] * 1e6),
+                               'args': span['args']})
+        for thread, tid in threads.items():
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': tid, 'args': {'name': thread}})
+        return {'traceEvents': events}
+
+
+def timed(category):
+    """Records the duration of an Apic method in its timing, under category"""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(self, *args, **kwargs):
+            with self.timing.span(category, func.__name__):
+                return func(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class MoCache(object):
+    """LRU cache of lookup results with per-class TTLs, bounded to CACHE_MAX_MOS objects in total."""
+
+    def __init__(self, max_mos=CACHE_MAX_MOS):
+        self.max_mos = max_mos
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None or entry[0] < time.time():
+                if entry is not None:
+                    self.size -= entry[2]
+                self.misses += 1
+                return None
+            # re-insert to mark the entry as most recently used
+            self.entries[key] = entry
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, mos):
+        fabric, class_name = key[:2]
+        ttl = CACHE_TTL.get(class_name, CACHE_DEFAULT_TTL)
+        size = len(mos) + sum(mo.numChildren for mo in mos)
+        if not ttl or size > self.max_mos:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old[2]
+            self.entries[key] = (time.time() + ttl, mos, size)
+            self.size += size
+            while self.size > self.max_mos:
+                evicted = self.entries.popitem(last=False)[1]
+                self.size -= evicted[2]
+
+    def invalidate(self, fabric=None, class_name=None):
+        with self.lock:
+            for key in list(self.entries):
+                if (fabric is None or key[0] == fabric) and (class_name is None or key[1] == class_name):
+                    self.size -= self.entries.pop(key)[2]
+
+
+class QueryEngine(object):
+    """Runs independent APIC lookups concurrently, at most QUERY_CONCURRENCY at a time."""
+
+    def __init__(self, md, fabric='', cache=None, concurrency=QUERY_CONCURRENCY, on_auth_error=None,
+                 on_connection_error=None, timing=None):
+        self.md = md
+        self.fabric = fabric
+        self.cache = cache if cache is not None else MoCache()
+        self.timing = timing if timing is not None else Timing()
+        self.slots = threading.BoundedSemaphore(concurrency)
+        self.on_auth_error = on_auth_error
+        self.on_connection_error = on_connection_error
+
+    def lookup(self, class_name, parent_dn='', **kwargs):
+        key = (self.fabric, class_name, parent_dn, tuple(sorted(kwargs.items())))
+        mos = self.cache.get(key)
+        if mos is None:
+            mos = self.fetch(class_name, parent_dn, kwargs)
+            self.cache.put(key, mos)
+        return mos
+
+    def fetch(self, class_name, parent_dn, kwargs):
+        md = self.md
+        try:
+            return self.query(md, class_name, parent_dn, kwargs)
+        except Exception as error:
+            if is_auth_error(error) and self.on_auth_error:
+                # the session expired or was revoked, log in again and retry once
+                self.on_auth_error()
+            elif is_connection_error(error) and self.on_connection_error:
+                # the APIC is unreachable or too slow, retry once on another one
+                if not self.on_connection_error(md):
+                    raise error
+            else:
+                raise
+            return self.query(self.md, class_name, parent_dn, kwargs)
+
+    def query(self, md, class_name, parent_dn, kwargs):
+        with self.slots:
+            with self.timing.span('query', class_name, parent=parent_dn, filter=kwargs.get('propFilter', ''),
+                                  page=kwargs.get('page', '')) as args:
+                mos = md.lookupByClass(class_name, parent_dn, **kwargs)
+                args['mos'] = len(mos)
+                if hasattr(md, 'response_size'):
+                    args['bytes'] = md.response_size()
+                return mos
+
+    def lookup_pages(self, class_name, parent_dn='', page_size=PAGE_SIZE, **kwargs):
+        """
+        Returns an iterator over a large class which is queried page by page in DN order, the next page is
+        fetched while the current one is processed. The first page is requested straight away.
+        """
+        key = (self.fabric, class_name, parent_dn, tuple(sorted(kwargs.items())))
+        mos = self.cache.get(key)
+        if mos is not None:
+            return iter(mos)
+
+        kwargs = dict(kwargs, orderBy='{0}.dn'.format(class_name), pageSize=page_size)
+        first_page = submit(self.fetch, class_name, parent_dn, dict(kwargs, page=0))
+        return self.iter_pages(key, first_page, class_name, parent_dn, page_size, kwargs)
+
+    def iter_pages(self, key, next_page, class_name, parent_dn, page_size, kwargs):
+        collected = []
+        size = 0
+        page = 0
+        while next_page:
+            mos = next_page()
+            page += 1
+            if len(mos) == page_size:
+                next_page = submit(self.fetch, class_name, parent_dn, dict(kwargs, page=page))
+            else:
+                next_page = None
+            # keep the pages for the cache only while they fit in it, children count as MoCache.put does
+            if collected is not None:
+                collected.extend(mos)
+                size += len(mos) + sum(mo.numChildren for mo in mos)
+                if size > self.cache.max_mos:
+                    collected = None
+            for mo in mos:
+                yield mo
+        if collected is not None:
+            self.cache.put(key, collected)
+
+    def lookup_many(self, queries):
+        """Runs (class_name, parent_dn, kwargs) queries in parallel, results are returned in the same order."""
+        return self.run([(self.lookup, (class_name, parent_dn), kwargs) for class_name, parent_dn, kwargs in queries])
+
+    def run(self, calls):
+        """Runs (function, args, kwargs) calls in parallel threads and returns their results in order."""
+        return run_parallel(calls)
+
+
+class Controller(object):
+    """An APIC of the fabric cluster, probed at login for reachability and response time."""
+
+    def __init__(self, address, username, password):
+        self.address = address
+        self.username = username
+        self.password = password
+        self.ls = None
+        self.md = None
+        self.latency = None
+        self.error = None
+
+    def probe(self):
+        """Logs in and times the login plus a small query, latency is left as None if the APIC fails"""
+        start = time.time()
+        try:
+            import cobra.mit.access
+            import cobra.mit.session
+            self.ls = cobra.mit.session.LoginSession('https://' + self.address, self.username, self.password,
+                                                     timeout=APIC_TIMEOUT)
+            self.md = cobra.mit.access.MoDirectory(self.ls)
+            self.md.login()
+            self.md.lookupByClass('topSystem', propFilter=eq_filter('topSystem', 'role', 'controller'))
+            self.latency = time.time() - start
+            self.error = None
+        except Exception as error:
+            self.latency = None
+            self.error = error
+
+
+class VlanIndex(object):
+    """VLAN slot arrays per pool and domain, plus an encap to EPG static binding index."""
+
+    def __init__(self, vlan_pools, epgs):
+        self.vlan_pools = vlan_pools
+        self.epgs = epgs
+        self.slots = [[] for vlan in range(4097)]
+        self.pools = {}
+        self.domains = {}
+        self.bindings = {}
+
+        for item in vlan_pools:
+            pool = self.pools.setdefault((item['name'], item['alloc']), bytearray(4097))
+            for vlan in range(item['from_vlan'], item['to_vlan'] + 1):
+                self.slots[vlan].append(item)
+                pool[vlan] = 1
+        for item in vlan_pools:
+            for domain in item['domains']:
+                self.domains.setdefault(domain, set()).add((item['name'], item['alloc']))
+
+        for epg in epgs:
+            for path in epg['paths']:
+                self.bindings.setdefault(path['encap'], []).append((epg, path))
+
+    def is_current(self, vlan_pools, epgs):
+        # the collectors build new lists on every command, the cached MOs they come from rarely change
+        return self.vlan_pools == vlan_pools and self.epgs == epgs
+
+    def pool_blocks(self, vlan):
+        return self.slots[vlan]
+
+    def range_blocks(self, from_vlan, to_vlan):
+        """Pool blocks overlapping from_vlan-to_vlan, in the order their first VLAN in the range comes up"""
+        blocks = [item for item in self.vlan_pools if item['from_vlan'] <= to_vlan and item['to_vlan'] >= from_vlan]
+        return sorted(blocks, key=lambda item: max(item['from_vlan'], from_vlan))
+
+    def epgs_using(self, vlan):
+        epgs = []
+        seen = set()
+        for epg, path in self.bindings.get(str(vlan), []):
+            if id(epg) not in seen:
+                seen.add(id(epg))
+                epgs.append(epg)
+        return epgs
+
+    def free_ranges(self, pool_key):
+        # static bindings carry no domain, a VLAN bound by any EPG counts as used in every pool
+        pool = self.pools[pool_key]
+        return to_ranges(vlan for vlan in range(1, 4097) if pool[vlan] and str(vlan) not in self.bindings)
+
+    def overlaps(self):
+        """Yields (domain, pool_a, pool_b, from_vlan, to_vlan) for pools overlapping within a domain"""
+        for domain in sorted(self.domains):
+            pool_keys = sorted(self.domains[domain])
+            usage = bytearray(4097)
+            for pool_key in pool_keys:
+                pool = self.pools[pool_key]
+                for vlan in range(1, 4097):
+                    usage[vlan] += pool[vlan]
+            shared = [vlan for vlan in range(1, 4097) if usage[vlan] > 1]
+            if not shared:
+                continue
+            for i, pool_a in enumerate(pool_keys):
+                for pool_b in pool_keys[i + 1:]:
+                    common = [vlan for vlan in shared if self.pools[pool_a][vlan] and self.pools[pool_b][vlan]]
+                    for from_vlan, to_vlan in to_ranges(common):
+                        yield domain, pool_a, pool_b, from_vlan, to_vlan
+
+
+def parse_intf_id(intf_id):
+    """Splits an interface id, i.e. 1/10 or breakout port 1/1/2, into (module, port, sub_port)"""
+    parts = [int(part) for part in intf_id.split('/')]
+    return tuple(parts + [0] * (3 - len(parts)))
+
+
+def port_key(pod, node, intf_id):
+    return (int(pod), int(node)) + parse_intf_id(intf_id)
+
+
+class Port(object):
+    """A leaf interface, the values repeated across ports are interned to share one string."""
+
+    __slots__ = ('node', 'intf_id', 'portT', 'usage', 'descr', 'operSt', 'operSpeed', 'operDuplex', 'port_sr_name',
+                 'policy_group')
+
+    def __init__(self, node, intf_id, portT, usage, descr):
+        self.node = intern(node)
+        self.intf_id = intern(intf_id)
+        self.portT = intern(portT)
+        self.usage = intern(usage)
+        self.descr = descr
+        self.operSt = ''
+        self.operSpeed = ''
+        self.operDuplex = ''
+        self.port_sr_name = ''
+        self.policy_group = ''
+
+    def set_oper_state(self, oper_st, oper_speed, oper_duplex):
+        self.operSt = intern(oper_st)
+        self.operSpeed = intern(oper_speed)
+        self.operDuplex = intern(oper_duplex)
+
+    def set_port_selector(self, port_sr_name, policy_group):
+        self.port_sr_name = intern(port_sr_name)
+        self.policy_group = intern(policy_group)
+
+
+class InterfaceTable(object):
+    """
+    Leaf interfaces keyed by (pod, node, module, port, sub_port). Port selectors and user input don't carry the pod,
+    so keys can also be found by (node, module, port, sub_port).
+    """
+
+    def __init__(self):
+        self.ports = {}
+        self.node_keys = {}
+
+    def add(self, key, port):
+        self.ports[key] = port
+        self.node_keys[key[1:]] = key
+
+    def find(self, node, intf_id):
+        """Returns the key of interface intf_id on node, or None if the node has no such interface"""
+        return self.node_keys.get((int(node),) + parse_intf_id(intf_id))
+
+    def __getitem__(self, key):
+        return self.ports[key]
+
+    def __contains__(self, key):
+        return key in self.ports
+
+    def __len__(self):
+        return len(self.ports)
+
+    def keys(self):
+        return sorted(self.ports)
+
+
+class PortSelectorMap(object):
+    """
+    Port selector ranges of the access policies per node range. Ranges are only resolved for the nodes and ports which
+    are looked up, so the cost follows the ports present on the leafs rather than the configured ranges.
+    """
+
+    def __init__(self):
+        self.node_ranges = []
+        self.node_blocks = {}
+
+    def add(self, from_node, to_node, blocks):
+        """blocks are (from_card, to_card, from_port, to_port, from_sub_port, to_sub_port, port_sr_name, policy_group)"""
+        self.node_ranges.append((from_node, to_node, blocks))
+        self.node_blocks = {}
+
+    def blocks(self, node):
+        if node not in self.node_blocks:
+            self.node_blocks[node] = [block for from_node, to_node, blocks in self.node_ranges
+                                      if from_node <= node <= to_node for block in blocks]
+        return self.node_blocks[node]
+
+    def find(self, node, module, port, sub_port):
+        """Returns (port_sr_name, policy_group) of the selector the port is in, or None"""
+        for from_card, to_card, from_port, to_port, from_sub, to_sub, port_sr_name, policy_group in self.blocks(node):
+            if from_card <= module <= to_card and from_port <= port <= to_port and from_sub <= sub_port <= to_sub:
+                return port_sr_name, policy_group
+        return None
+
+
+class PrefixIndex(object):
+    """Sorted names, completed by prefix and looked up with binary search."""
+
+    def __init__(self, names=()):
+        self.names = sorted(set(names))
+
+    def complete(self, prefix):
+        start = bisect_left(self.names, prefix)
+        end = bisect_left(self.names, prefix + '\xff', start)
+        return self.names[start:end]
+
+    def __contains__(self, name):
+        i = bisect_left(self.names, name)
+        return i < len(self.names) and self.names[i] == name
+
+    def __len__(self):
+        return len(self.names)
+
+
+class Completions(object):
+    """
+    Names the commands complete and validate for a fabric: EPGs (also as TENANT/EPG and TENANT/AP/EPG), leafs,
+    interfaces per leaf, VLAN pools and snapshot IDs. Saved to path between sessions, so a login only fetches what
+    changed since.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.stamp = ''
+        self.updated = 0
+        self.epg_dns = set()
+        self.leaf_dns = {}
+        self.interface_ids = {}
+        self.pool_names = []
+        self.snapshot_ids = []
+        self.indexes = {}
+        self.interfaces = {}
+        self.lock = threading.Lock()
+        self.rebuild()
+
+    def rebuild(self):
+        epg_names = []
+        for dn in self.epg_dns:
+            tn, ap, name = parse_epg_dn(dn)
+            epg_names += [name, '{0}/{1}'.format(tn, name), '{0}/{1}/{2}'.format(tn, ap, name)]
+        self.indexes = {'epg': PrefixIndex(epg_names), 'leaf': PrefixIndex(self.leaf_dns),
+                        'pool': PrefixIndex(self.pool_names), 'snapshot': PrefixIndex(self.snapshot_ids)}
+        self.interfaces = dict((leaf, PrefixIndex(ids)) for leaf, ids in self.interface_ids.items())
+
+    def __getitem__(self, kind):
+        return self.indexes[kind]
+
+    def set_epgs(self, epg_dns, stamp):
+        with self.lock:
+            self.epg_dns = set(epg_dns)
+            self.stamp = stamp
+            self.updated = time.time()
+            self.rebuild()
+
+    def update_epgs(self, changes, stamp):
+        """Applies (dn, deleted) changes in the order they were made"""
+        with self.lock:
+            for dn, deleted in changes:
+                if deleted:
+                    self.epg_dns.discard(dn)
+                else:
+                    self.epg_dns.add(dn)
+            self.stamp = stamp
+            self.rebuild()
+
+    def set(self, attribute, values):
+        with self.lock:
+            setattr(self, attribute, values)
+            self.rebuild()
+
+    def set_interfaces(self, leaf, ids):
+        with self.lock:
+            self.interface_ids[leaf] = sorted(ids)
+            self.interfaces[leaf] = PrefixIndex(ids)
+
+    def load(self):
+        """Reads the saved names, returns False if there are none"""
+        try:
+            with open(self.path) as saved:
+                state = json_loads(saved.read())
+        except (IOError, TypeError, ValueError):
+            return False
+        with self.lock:
+            self.stamp = str(state['stamp'])
+            self.updated = state['updated']
+            self.epg_dns = set(str(dn) for dn in state['epgs'])
+            self.leaf_dns = dict((str(leaf), str(dn)) for leaf, dn in state['leafs'].items())
+            self.interface_ids = dict((str(leaf), [str(i) for i in ids]) for leaf, ids in state['interfaces'].items())
+            self.pool_names = [str(name) for name in state['pools']]
+            self.snapshot_ids = [str(i) for i in state['snapshots']]
+            self.rebuild()
+        return True
+
+    def save(self):
+        if not self.path:
+            return
+        with self.lock:
+            state = {'stamp': self.stamp, 'updated': self.updated, 'epgs': sorted(self.epg_dns),
+                     'leafs': self.leaf_dns, 'interfaces': self.interface_ids, 'pools': self.pool_names,
+                     'snapshots': self.snapshot_ids}
+        # completions work without the file, it only saves the queries at the next login
+        try:
+            if not os.path.isdir(os.path.dirname(self.path)):
+                os.makedirs(os.path.dirname(self.path))
+            with open(self.path + '.tmp', 'w') as saved:
+                json.dump(state, saved)
+            os.rename(self.path + '.tmp', self.path)
+        except (IOError, OSError):
+            pass
+
+
+class TableWriter(object):
+    """Collects rows into a PrettyTable which is printed when the table is closed."""
+
+    def __init__(self, columns, context=None):
+        self.table = PrettyTable(columns)
+        self.table.align = "l"
+        self.table.vertical_char = ' '
+        self.table.junction_char = ' '
+
+    def add_row(self, row):
+        self.table.add_row(row)
+
+    def close(self):
+        print(self.table)
+
+
+class StreamWriter(object):
+    """
+    Writes rows out as soon as they are added, in csv, ndjson or json (an array per command, end_json closes it)
+    format. Context values, i.e. the EPG a table of paths belongs to, are added to every row.
+    """
+    # per thread, the daemon renders the commands of several clients at once
+    state = threading.local()
+
+    def __init__(self, output_format, columns, context=None, stream=None):
+        context = context or OrderedDict()
+        self.output_format = output_format
+        self.stream = stream or sys.stdout
+        self.columns = list(context.keys()) + list(columns)
+        self.context = list(context.values())
+        if output_format == 'csv':
+            self.writer = csv.writer(self.stream)
+            # consecutive tables with the same columns continue the same csv
+            if getattr(StreamWriter.state, 'header', None) != self.columns:
+                self.writer.writerow(self.columns)
+                StreamWriter.state.header = self.columns
+        elif output_format == 'json' and getattr(StreamWriter.state, 'json', None) is None:
+            # the rows of all tables of a command go into one array
+            StreamWriter.state.json = {'stream': self.stream, 'rows': 0}
+
+    def add_row(self, row):
+        values = self.context + list(row)
+        if self.output_format == 'csv':
+            self.writer.writerow(values)
+        else:
+            line = json.dumps(OrderedDict(zip(self.columns, values)))
+            if self.output_format == 'json':
+                line = ('[\n' if StreamWriter.state.json['rows'] == 0 else ',\n') + line
+                StreamWriter.state.json['rows'] += 1
+            else:
+                line += '\n'
+            self.stream.write(line)
+        self.stream.flush()
+
+    def close(self):
+        pass
+
+    @staticmethod
+    def end_json():
+        """Closes the JSON array of the command, if it wrote any table"""
+        array = getattr(StreamWriter.state, 'json', None)
+        if array is not None:
+            array['stream'].write('\n]\n' if array['rows'] else '[]\n')
+            array['stream'].flush()
+            StreamWriter.state.json = None
+
+
+class CaptureWriter(object):
+    """Keeps the rows of a table in memory, used to merge the output of several fabrics."""
+
+    def __init__(self, captured, columns, context=None):
+        context = context or OrderedDict()
+        self.columns = list(context.keys()) + list(columns)
+        self.context = list(context.values())
+        self.rows = []
+        captured.append(self)
+
+    def add_row(self, row):
+        self.rows.append(self.context + list(row))
+
+    def close(self):
+        pass
+
+
+def split_dn(dn):
+    """Splits a DN into its RNs, ignoring slashes inside brackets, i.e. topology/pod-1/paths-101/pathep-[eth1/1]"""
+    rns = []
+    depth = 0
+    start = 0
+    for i, char in enumerate(dn):
+        if char == '[':
+            depth += 1
+        elif char == ']':
+            depth -= 1
+        elif char == '/' and depth == 0:
+            rns.append(dn[start:i])
+            start = i + 1
+    rns.append(dn[start:])
+    return rns
+
+
+def split_dn_parent(dn):
+    return '/'.join(split_dn(dn)[:-1])
+
+
+def memoize(max_size=DN_CACHE_SIZE):
+    """Caches the results of a single argument function, dropping the least recently used beyond max_size"""
+    def decorator(func):
+        cache = OrderedDict()
+        lock = threading.Lock()
+
+        def wrapper(arg):
+            with lock:
+                if arg in cache:
+                    value = cache.pop(arg)
+                    cache[arg] = value
+                    return value
+            value = func(arg)
+            with lock:
+                cache[arg] = value
+                if len(cache) > max_size:
+                    cache.popitem(last=False)
+            return value
+
+        wrapper.__doc__ = func.__doc__
+        return wrapper
+    return decorator
+
+
+EPG_DN = re.compile(r'^uni/tn-([^/]+)/ap-([^/]+)/epg-([^/]+)$')
+PATH_DN = re.compile(r'^topology/pod-(\d+)/(?:prot)?paths-([\d-]+)/(?:ext(?:prot)?paths-([\d-]+)/)?pathep-\[(.+)\]$')
+NODE_DN = re.compile(r'^topology/pod-(\d+)/node-(\d+)(?:/|$)')
+PHYS_DN = re.compile(r'^topology/pod-(\d+)/node-(\d+)/sys/phys-\[eth([\d/]+)\]')
+INFRA_DN = re.compile(r'^uni/infra/(?:nprof|accportprof)-([^/]+)')
+ENCAP_BLOCK_DN = re.compile(r'/from-\[vlan-(\d+)\]-to-\[vlan-(\d+)\]$')
+
+PathDn = namedtuple('PathDn', 'pod nodes intf_id bundle fexes')
+
+
+@memoize()
+def parse_epg_dn(dn):
+    """uni/tn-T1/ap-AP1/epg-WEB -> (tenant, app_profile, epg)"""
+    return EPG_DN.match(dn).groups()
+
+
+@memoize()
+def parse_path_dn(dn):
+    """
+    Static binding targets: topology/pod-1/paths-101/pathep-[eth1/3] -> PathDn('1', ('101',), '1/3', '', ()) and
+    topology/pod-1/protpaths-101-102/pathep-[VPC1] -> PathDn('1', ('101', '102'), '', 'VPC1', ()). Port channels and
+    vPCs are named after their policy group, which is returned as bundle. FEX ids of paths-101/extpaths-111/... are
+    returned as fexes. None for targets which are not a path.
+    """
+    match = PATH_DN.match(dn)
+    if not match:
+        return None
+    pod, nodes, fexes, pathep = match.groups()
+    fexes = tuple(fexes.split('-')) if fexes else ()
+    if pathep.startswith('eth'):
+        return PathDn(pod, tuple(nodes.split('-')), pathep[3:], '', fexes)
+    return PathDn(pod, tuple(nodes.split('-')), '', pathep, fexes)
+
+
+@memoize()
+def parse_node_dn(dn):
+    """topology/pod-1/node-101[/...] -> (pod, node)"""
+    return NODE_DN.match(dn).groups()
+
+
+@memoize()
+def parse_phys_dn(dn):
+    """topology/pod-1/node-101/sys/phys-[eth1/1/2] -> (pod, node, '1/1/2'), None for non ethernet ports"""
+    match = PHYS_DN.match(dn)
+    return match.groups() if match else None
+
+
+@memoize()
+def parse_infra_dn(dn):
+    """Name of the switch or interface profile a uni/infra/nprof-X/... or uni/infra/accportprof-X/... DN is under"""
+    return INFRA_DN.match(dn).group(1)
+
+
+@memoize()
+def parse_encap_block_dn(dn):
+    """uni/infra/vlanns-[POOL1]-static/from-[vlan-100]-to-[vlan-199] -> (100, 199)"""
+    from_vlan, to_vlan = ENCAP_BLOCK_DN.search(dn).groups()
+    return int(from_vlan), int(to_vlan)
+
+
+@memoize()
+def rn_name(dn):
+    """Name part of the last RN, i.e. uni/infra/funcprof/accbundle-VPC1 -> VPC1"""
+    return split_dn(dn)[-1].split('-', 1)[-1]
+
+
+def static_path(t_dn, encap):
+    """Static binding of an EPG to the interface, port channel or vPC in t_dn, None when it can't be shown"""
+    path = parse_path_dn(t_dn)
+    if path is None:
+        return None
+    if path.bundle:
+        return {'tDn': t_dn, 'vpc': path.bundle, 'nodes': path.nodes, 'encap': encap, 'key': ()}
+    if len(path.fexes) > 1:
+        # a host port of a dual-homed FEX is on both leafs, there is no single interface for it
+        return None
+    # FEX host ports are interfaces of the parent leaf, i.e. eth111/1/1 for port 1/1 of FEX 111
+    intf_id = '/'.join(path.fexes + (path.intf_id, ))
+    return {'tDn': t_dn, 'key': port_key(path.pod, path.nodes[0], intf_id), 'node': path.nodes[0],
+            'intf_id': intf_id, 'encap': encap}
+
+
+class EventStream(object):
+    """Change events of subscribed APIC queries, received over the APIC websocket."""
+
+    def __init__(self, address, token, rest_get):
+        self.rest_get = rest_get
+        self.subscription_ids = []
+        self.events = Queue.Queue()
+        self.ws = websocket.create_connection('wss://{0}/socket{1}'.format(address, token),
+                                              sslopt={'cert_reqs': ssl.CERT_NONE}, timeout=APIC_TIMEOUT)
+        self.ws.settimeout(None)
+        thread = threading.Thread(target=self.receive)
+        thread.daemon = True
+        thread.start()
+
+    def receive(self):
+        # events are queued as (class_name, attributes), None tells the reader the socket is gone
+        try:
+            while True:
+                message = json.loads(self.ws.recv())
+                for item in message.get('imdata', []):
+                    for class_name, body in item.items():
+                        self.events.put((class_name, body['attributes']))
+        except Exception:
+            self.events.put(None)
+
+    def subscribe(self, path, params=None):
+        response = self.rest_get(path, dict(params or {}, subscription='yes'))
+        self.subscription_ids.append(response['subscriptionId'])
+        return response['imdata']
+
+    def refresh(self):
+        # the APIC drops subscriptions which aren't refreshed within 90 seconds
+        for subscription_id in self.subscription_ids:
+            self.rest_get('/api/subscriptionRefresh.json', {'id': subscription_id})
+
+    def close(self):
+        try:
+            self.ws.close()
+        except Exception:
+            pass
+
+
+class RecordMeta(object):
+    classes = {}
+
+    def __init__(self, class_name):
+        self.moClassName = class_name
+
+    @classmethod
+    def get(cls, class_name):
+        if class_name not in cls.classes:
+            cls.classes[class_name] = cls(class_name)
+        return cls.classes[class_name]
+
+
+class Record(object):
+    """Read-only stand-in for a Cobra MO, for objects which are not loaded through Cobra."""
+    __slots__ = ('meta', 'dn', 'attributes', 'children')
+
+    def __init__(self, class_name, dn, attributes, children=None):
+        self.meta = RecordMeta.get(class_name)
+        self.dn = dn
+        self.attributes = attributes
+        self.children = children if children is not None else []
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        # Cobra appends _ to properties which are python keywords, i.e. from_ and to_. Some classes are named that
+        # way on the wire too (infraNodeBlk from_), others not (fvnsEncapBlk from), so the exact name goes first
+        return self.attributes.get(name, self.attributes.get(name.rstrip('_'), ''))
+
+    @classmethod
+    def from_json(cls, item, parent_dn=''):
+        """Builds a Record from an APIC JSON object, children only carry their rn so their dn is built from parent_dn"""
+        (class_name, body), = item.items()
+        attributes = str_attributes(body['attributes'])
+        dn = attributes.get('dn') or parent_dn + '/' + attributes['rn']
+        children = [cls.from_json(child, dn) for child in body.get('children', [])]
+        return cls(str(class_name), dn, attributes, children)
+
+    @property
+    def rn(self):
+        return split_dn(self.dn)[-1]
+
+    @property
+    def numChildren(self):
+        return len(self.children)
+
+
+def str_attributes(attributes):
+    """Decoded JSON attributes as utf-8 str values, like the attributes of Cobra MOs"""
+    return dict((str(name), value.encode('utf-8')) for name, value in attributes.items())
+
+
+def mo_attributes(mo):
+    # keyed by the names the APIC uses, i.e. from_ for infraNodeBlk, Record looks them up the same way
+    if isinstance(mo, Record):
+        return dict(mo.attributes)
+    attributes = {}
+    for prop in mo.meta.props:
+        value = getattr(mo, prop.name, None)
+        if value is not None:
+            attributes[prop.moPropName] = str(value)
+    return attributes
+
+
+def state_rows(mo, parent_dn=''):
+    """Yields (dn, class_name, parent_dn, attributes) rows for an MO and its children"""
+    dn = str(mo.dn)
+    yield dn, mo.meta.moClassName, parent_dn, json.dumps(mo_attributes(mo))
+    for child in mo.children:
+        for row in state_rows(child, dn):
+            yield row
+
+
+FILTER_OP = re.compile(r'\s*(\w+)\s*\(')
+FILTER_WORD = re.compile(r'\s*([^,()\s"]+)')
+
+
+def parse_filter(text, pos=0):
+    """Parses an APIC propFilter expression into nested (operator, arguments) tuples"""
+    match = FILTER_OP.match(text, pos)
+    operator = match.group(1)
+    pos = match.end()
+    arguments = []
+    while True:
+        while text[pos] in ' ,':
+            pos += 1
+        if text[pos] == ')':
+            return (operator, arguments), pos + 1
+        if text[pos] == '"':
+            end = text.index('"', pos + 1)
+            arguments.append(text[pos + 1:end])
+            pos = end + 1
+        elif FILTER_OP.match(text, pos):
+            expression, pos = parse_filter(text, pos)
+            arguments.append(expression)
+        else:
+            match = FILTER_WORD.match(text, pos)
+            arguments.append(match.group(1))
+            pos = match.end()
+
+
+def match_filter(expression, mo):
+    operator, arguments = expression
+    if operator == 'and':
+        return all(match_filter(argument, mo) for argument in arguments)
+    if operator == 'or':
+        return any(match_filter(argument, mo) for argument in arguments)
+    if operator == 'not':
+        return not match_filter(arguments[0], mo)
+
+    prop = arguments[0].split('.', 1)[-1]
+    value = str(mo.dn) if prop == 'dn' else str(getattr(mo, prop))
+    values = arguments[1:]
+    if all(item.isdigit() for item in [value] + values):
+        value, values = int(value), [int(item) for item in values]
+    if operator == 'eq':
+        return value == values[0]
+    if operator == 'ne':
+        return value != values[0]
+    if operator == 'wcard':
+        return re.search(str(values[0]), str(value)) is not None
+    if operator == 'gt':
+        return value > values[0]
+    if operator == 'ge':
+        return value >= values[0]
+    if operator == 'lt':
+        return value < values[0]
+    if operator == 'le':
+        return value <= values[0]
+    if operator == 'bw':
+        return values[0] <= value <= values[1]
+    raise ValueError('Unsupported filter operator ' + operator)
+
+
+class OfflineDirectory(object):
+    """
+    Serves lookups from a fabric state file written by export-state in place of a MoDirectory. Objects are read from
+    SQLite on demand, so only the classes and subtrees a command asks for are loaded.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.filters = {}
+        self.info = dict(self.db().execute('SELECT key, value FROM info'))
+
+    def db(self):
+        # sqlite connections can't be shared between the engine threads
+        if not hasattr(self.local, 'db'):
+            self.local.db = sqlite3.connect(self.path)
+        return self.local.db
+
+    def login(self):
+        pass
+
+    def logout(self):
+        pass
+
+    def reauth(self):
+        pass
+
+    def commit(self, request):
+        raise IOError('Fabric state file is read only')
+
+    def records(self, sql, params):
+        return [Record(str(class_name), dn.encode('utf-8'), str_attributes(json.loads(data)))
+                for dn, class_name, data in self.db().execute('SELECT dn, class_name, data FROM mo ' + sql, params)]
+
+    def add_children(self, records, class_filter, recursive):
+        by_dn = dict((record.dn, record) for record in records)
+        dns = list(by_dn)
+        children = []
+        for i in range(0, len(dns), 500):
+            chunk = dns[i:i + 500]
+            for child in self.records('WHERE parent_dn IN ({0}) ORDER BY dn'.format(','.join('?' * len(chunk))),
+                                      chunk):
+                if not class_filter or child.meta.moClassName in class_filter:
+                    by_dn[split_dn_parent(child.dn)].children.append(child)
+                    children.append(child)
+        if recursive and children:
+            self.add_children(children, class_filter, recursive)
+
+    def lookupByDn(self, dn, **kwargs):
+        records = self.records('WHERE dn = ?', (str(dn),))
+        return records[0] if records else None
+
+    def lookupByClass(self, class_name, parentDn=None, propFilter=None, subtree=None, subtreeClassFilter=None,
+                      pageSize=None, page=0, **kwargs):
+        sql = 'WHERE class_name = ?'
+        params = [class_name]
+        if parentDn:
+            # every DN below parentDn sorts between 'parentDn/' and 'parentDn0'
+            sql += ' AND dn > ? AND dn < ?'
+            params += [str(parentDn) + '/', str(parentDn) + '0']
+        sql += ' ORDER BY dn'
+        if pageSize is not None and not propFilter:
+            sql += ' LIMIT ? OFFSET ?'
+            params += [int(pageSize), int(pageSize) * int(page)]
+        records = self.records(sql, params)
+
+        if propFilter:
+            if propFilter not in self.filters:
+                self.filters[propFilter] = parse_filter(propFilter)[0]
+            records = [record for record in records if match_filter(self.filters[propFilter], record)]
+            if pageSize is not None:
+                records = records[int(pageSize) * int(page):int(pageSize) * (int(page) + 1)]
+
+        if subtree in ('children', 'full') and records:
+            class_filter = subtreeClassFilter.split(',') if subtreeClassFilter else []
+            self.add_children(records, class_filter, subtree == 'full')
+        return records
+
+
+class RestError(Exception):
+    """An error status returned by the APIC REST API, with the same attributes as a Cobra QueryError."""
+
+    def __init__(self, http_code, text):
+        Exception.__init__(self, '{0}: {1}'.format(http_code, text))
+        self.httpCode = http_code
+        self.error = text
+
+
+class RestDirectory(object):
+    """
+    Read-only MoDirectory stand-in which queries the APIC REST API with the session cookie of a Cobra LoginSession and
+    returns Records, skipping the construction of Cobra MOs. Writes still go through Cobra.
+    """
+
+    # lookupByClass arguments and the APIC query options they map to
+    OPTIONS = {'propFilter': 'query-target-filter', 'subtree': 'rsp-subtree', 'subtreeClassFilter': 'rsp-subtree-class',
+               'propInclude': 'rsp-prop-include', 'orderBy': 'order-by', 'pageSize': 'page-size', 'page': 'page'}
+
+    def __init__(self, address, session):
+        self.url = 'https://' + address
+        self.session = session
+        self.http = requests.Session()
+        self.local = threading.local()
+
+    def response_size(self):
+        return getattr(self.local, 'size', None)
+
+    def lookupByClass(self, class_name, parentDn=None, **kwargs):
+        params = dict((self.OPTIONS.get(name, name), value) for name, value in kwargs.items())
+        if parentDn:
+            path = '/api/mo/{0}.json'.format(parentDn)
+            params.update({'query-target': 'subtree', 'target-subtree-class': class_name})
+        else:
+            path = '/api/class/{0}.json'.format(class_name)
+        response = self.http.get(self.url + path, params=params, cookies={'APIC-cookie': self.session.cookie},
+                                 verify=False, timeout=APIC_TIMEOUT)
+        self.local.size = len(response.content)
+        if response.status_code != 200:
+            raise RestError(response.status_code, response.text)
+        return [Record.from_json(item) for item in json_loads(response.content)['imdata']]
+
+
+def write_state(path, fabric, sources):
+    """Writes the MOs of every iterable in sources to a new fabric state file, returns the number of objects"""
+    db = sqlite3.connect(path)
+    db.execute('CREATE TABLE info (key TEXT PRIMARY KEY, value TEXT)')
+    db.execute('CREATE TABLE mo (dn TEXT PRIMARY KEY, class_name TEXT, parent_dn TEXT, data TEXT)')
+    count = 0
+    for mos in sources:
+        rows = []
+        for mo in mos:
+            rows.extend(state_rows(mo))
+            if len(rows) >= 1000:
+                db.executemany('INSERT OR REPLACE INTO mo VALUES (?, ?, ?, ?)', rows)
+                count += len(rows)
+                rows = []
+        db.executemany('INSERT OR REPLACE INTO mo VALUES (?, ?, ?, ?)', rows)
+        count += len(rows)
+    db.execute('CREATE INDEX mo_class ON mo (class_name, dn)')
+    db.execute('CREATE INDEX mo_parent ON mo (parent_dn)')
+    db.executemany('INSERT INTO info VALUES (?, ?)', [('fabric', fabric), ('created', time.ctime())])
+    db.commit()
+    db.close()
+    return count
+
+
+def to_ranges(vlans):
+    """Collapses a sorted iterable of VLAN IDs into (from, to) ranges"""
+    ranges = []
+    for vlan in vlans:
+        if ranges and ranges[-1][1] == vlan - 1:
+            ranges[-1][1] = vlan
+        else:
+            ranges.append([vlan, vlan])
+    return [tuple(item) for item in ranges]
 
 
 class Apic(Cmd):
@@ -66,18 +1254,38 @@ class Apic(Cmd):
         self.can_connect = ''
         self.fabric = []
         self.snapshots = []
-        self.leafs = []
-        self.epg_names = []
+        self.completions = Completions()
         self.vlan_pools = []
-        self.idict = {}
+        self.vlan_index = None
+        self.interfaces = InterfaceTable()
+        self.node_pg_index = {}
+        self.vpc_index = {}
+        self.port_profiles = {}
         self.epgs = []
-        self.refresh_time_epoch = 0
+        self.path_index = {}
+        self.refresh_deadline = 0
+        self.completions_loaded = threading.Event()
         self.username = ''
         self.password = ''
         self.address = ''
+        self.controllers = []
+        self.session_lock = threading.RLock()
+        self.output_format = 'table'
+        self.captured = []
+        self.sessions = {}
+        self.strict_names = False
+        self.fabric_name = ''
+        self.cache = MoCache()
+        self.timing = Timing()
+        self.show_timing = False
+        self.failed = False
 
     def do_login(self, args):
-        """Usage: login [FABRIC_NAME]"""
+        """
+        Usage:
+        login [FABRIC_NAME] | ALL
+        login --offline <state_file>
+        """
         if self.can_connect:
             try:
                 self.disconnect()
@@ -87,34 +1295,167 @@ class Apic(Cmd):
         self.can_connect = ''
 
         if len(args) == 0:
-            print "Usage: login [FABRIC_NAME]"    
+            self.error("Usage: login [FABRIC_NAME]")
         else:
             parameters = args.split()
-            if parameters[0] in FABRICS.keys():
-                self.fabric = FABRICS[parameters[0]]
-                self.username = ''
-                self.password = ''
-                for apic_credentials in self.fabric:
-                    if not apic_credentials['username'] or not apic_credentials['password']:
-                        if not self.username and not self.password:
-                            self.username = raw_input('Enter username: ')
-                            self.password = getpass()
-                    else:
-                        self.username = apic_credentials['username']
-                        self.password = apic_credentials['password']
+            if parameters[0] == '--offline':
+                if len(parameters) == 2:
+                    self.connect_offline(parameters[1])
+                else:
+                    self.error('Usage: login --offline <state_file>')
+            elif parameters[0] == 'ALL':
+                self.login_sessions(sorted(FABRICS))
+                if self.sessions:
+                    self.can_connect = 'ALL'
+                    self.echo('Established connection to APIC in', ', '.join(sorted(self.sessions)))
+                    self.prompt = 'ACLI(ALL)>'
+                else:
+                    self.error('Cannot connect to any Fabric')
+            elif parameters[0] in FABRICS.keys():
+                self.connect_fabric(parameters[0], self.fabric_credentials(parameters[0]))
+                if self.can_connect:
+                    self.echo('Established connection to APIC in', self.can_connect)
+                else:
+                    self.error('Cannot connect to APIC in', parameters[0])
+
+    def fabric_credentials(self, fabric_name):
+        """Returns (address, username, password) for each APIC of a fabric, asking once for missing credentials"""
+        credentials = []
+        username = ''
+        password = ''
+        for apic_credentials in FABRICS[fabric_name]:
+            if not apic_credentials['username'] or not apic_credentials['password']:
+                if not username and not password:
+                    print 'Credentials for Fabric', fabric_name
+                    username = raw_input('Enter username: ')
+                    password = getpass()
+            else:
+                username = apic_credentials['username']
+                password = apic_credentials['password']
+            credentials.append((apic_credentials['address'], username, password))
+        return credentials
+
+    def connect_fabric(self, fabric_name, credentials):
+        """
+        Probes all APICs of the fabric in parallel and connects to the first one which answers, that is the fastest.
+        The others are added to fail over to, in order of latency, as their probes finish.
+        """
+        self.fabric = FABRICS[fabric_name]
+        self.fabric_name = fabric_name
+        controllers = [Controller(address, username, password) for address, username, password in credentials]
+        probed = Queue.Queue()
 
-                    self.address = apic_credentials['address']
+        def probe(controller):
+            controller.probe()
+            probed.put(controller)
+
+        for controller in controllers:
+            submit(probe, controller)
+
+        self.controllers = []
+        waiting = len(controllers)
+        while waiting and not self.controllers:
+            try:
+                # a timeout so Ctrl-C still reaches the main thread
+                controller = probed.get(True, 0.1)
+            except Queue.Empty:
+                continue
+            waiting -= 1
+            if controller.error is not None:
+                self.error('ERROR', controller.address, str(controller.error))
+            else:
+                self.controllers = [controller]
+        if waiting:
+            submit(self.add_controllers, probed, waiting, self.controllers[0])
+
+        if self.controllers:
+            try:
+                self.connect()
+                self.can_connect = fabric_name
+                self.prompt = 'ACLI({})>'.format(self.can_connect)
+            except Exception as error:
+                self.error('ERROR', str(error))
+
+    def add_controllers(self, probed, waiting, current):
+        for i in range(waiting):
+            controller = probed.get()
+            with self.session_lock:
+                # the fabric may have been left or switched while the probe was running
+                if controller.error is None and current in self.controllers:
+                    self.controllers = self.controllers[:1] + sorted(self.controllers[1:] + [controller],
+                                                                     key=lambda controller: controller.latency)
+                elif controller.md is not None:
                     try:
-                        self.connect()
-                        self.can_connect = parameters[0]
-                        print 'Established connection to APIC in', self.can_connect
-                        self.prompt = 'ACLI({})>'.format(self.can_connect)
-                        break
-                    except Exception as error:
-                        print 'ERROR', str(error)
+                        controller.md.logout()
+                    except:
                         pass
-                if not self.can_connect:
-                    print 'Cannot connect to APIC in', parameters[0]
+
+    def login_sessions(self, fabric_names):
+        """Opens a session to each fabric which doesn't have one yet, logging in to all of them in parallel"""
+        fabric_names = [name for name in fabric_names
+                        if name not in self.sessions or not self.sessions[name].can_connect]
+        # credentials are collected first, prompts can't be answered from parallel threads
+        credentials = [self.fabric_credentials(name) for name in fabric_names]
+        sessions = []
+        for name in fabric_names:
+            session = Apic()
+            session.output_format = 'capture'
+            session.cache = self.cache
+            session.strict_names = True
+            session.timing = self.timing
+            sessions.append(session)
+        run_parallel([(session.connect_fabric, (name, fabric_credentials), {})
+                      for session, name, fabric_credentials in zip(sessions, fabric_names, credentials)])
+        for session, name in zip(sessions, fabric_names):
+            if session.can_connect:
+                self.sessions[name] = session
+            else:
+                self.error('Cannot connect to APIC in', name)
+
+    def fan_out(self, fabric_names, command, args):
+        """Runs a command on several fabrics at once and prints the results as one table with a FABRIC column"""
+        self.login_sessions(fabric_names)
+        sessions = [(name, self.sessions[name]) for name in fabric_names if name in self.sessions]
+        for name, session in sessions:
+            session.captured = []
+            session.failed = False
+        run_parallel([(getattr(session, 'do_' + command), (args,), {}) for name, session in sessions])
+        if any(session.failed for name, session in sessions):
+            self.failed = True
+
+        merged = OrderedDict()
+        for name, session in sessions:
+            for table in session.captured:
+                rows = merged.setdefault(tuple(table.columns), [])
+                rows.extend([name] + row for row in table.rows)
+        for columns, rows in merged.items():
+            y = self.new_table(['FABRIC'] + list(columns))
+            for row in rows:
+                y.add_row(row)
+            y.close()
+
+    def do_export_state(self, args):
+        """
+        Saves the fabric state collected by the show commands to a file, which can be used with login --offline
+        Usage: export-state <file>
+        """
+        if not self.can_connect:
+            self.error('Login to a Fabric')
+        elif self.can_connect == 'ALL':
+            self.error('Login to a single Fabric to export its state')
+        elif len(args.split()) != 1:
+            self.error('Usage: export-state <file>')
+        elif os.path.exists(args.strip()):
+            self.error('ERROR: file already exists', args.strip())
+        else:
+            result = self.refresh_connection()
+            if result[0] == 1:
+                return
+            try:
+                count = self.export_state(args.strip())
+                self.echo('Exported', count, 'objects to', args.strip())
+            except Exception as error:
+                self.error('ERROR: failed to export fabric state', str(error))
 
     def do_config(self, args):
         """
@@ -122,31 +1463,33 @@ class Apic(Cmd):
         Usage:
         config snapshot new | <snapshot_id>
         """
-        if self.can_connect:
+        if self.can_connect == 'ALL':
+            self.error('Login to a single Fabric to change its configuration')
+        elif self.can_connect:
             if len(args) == 0:
-                print "Usage: config snapshot <id>. "
+                self.error("Usage: config snapshot <id>. ")
             elif 'snapshot' in args:
                 parameters = args.split()
                 if (len(parameters) == 2) and ('new' in parameters[1]):
                     description = raw_input('Enter description for the snapshot: ')
                     status = self.create_snapshot(description)
                     if status[0] == 0:
-                        print 'Snapshot has been successfully created'
+                        self.echo('Snapshot has been successfully created')
                     else:
-                        print 'ERROR: failed to create new snapshot'
+                        self.error('ERROR: failed to create new snapshot')
 
                 elif (len(parameters) == 2) and (int(parameters[1]) + 1 <= len(self.snapshots)):
                     snapshot_id = parameters[1]
                     description = raw_input('Enter new description for the snapshot: ')
                     status = self.update_snapshot_description(snapshot_id, description)
                     if status[0] == 0:
-                        print 'Description has been successfully updated for snapshot ID', snapshot_id
+                        self.echo('Description has been successfully updated for snapshot ID', snapshot_id)
                     else:
-                        print 'ERROR: failed to update description for snapshot ID', snapshot_id
+                        self.error('ERROR: failed to update description for snapshot ID', snapshot_id)
                 else:
-                    print 'Usage: config snapshot <id>.'
+                    self.error('Usage: config snapshot <id>.')
         else:
-            print 'Login to a Fabric'
+            self.error('Login to a Fabric')
         return
 
     def do_show(self, args):
@@ -155,71 +1498,109 @@ class Apic(Cmd):
         Usage:
         show epg [<epg_name>]
         show interface [<node>] [<leaf_interface, i.e. 1/10>]
-        show vlan <vlan_id> | pool
+        show vlan <vlan_id> | <from_vlan>-<to_vlan> | pool | free <pool_name> | overlap
+        (free counts a VLAN as used when any EPG binds it statically, whatever the domain)
         show snapshot
+        Any show command takes --fabrics <F1,F2> | ALL to run it on several fabrics at once
         """
+        parameters = args.split()
+        if '--fabrics' in parameters:
+            position = parameters.index('--fabrics')
+            fabric_names = parameters[position + 1:position + 2]
+            del parameters[position:position + 2]
+            if fabric_names and fabric_names[0] == 'ALL':
+                fabric_names = sorted(FABRICS)
+            elif fabric_names:
+                fabric_names = fabric_names[0].split(',')
+            unknown = [name for name in fabric_names if name not in FABRICS]
+            if not fabric_names or unknown:
+                self.error('Usage: show ... --fabrics <F1,F2> | ALL, unknown Fabric', ', '.join(unknown))
+            else:
+                self.fan_out(fabric_names, 'show', ' '.join(parameters))
+            return
+        if self.can_connect == 'ALL':
+            self.fan_out(sorted(self.sessions), 'show', args)
+            return
         if self.can_connect:
-            if len(args) == 0:
-                print "Usage: show epg, show interfaces or show vlan."
-            elif 'epg'in args:
-                parameters = args.split()
+            if len(parameters) == 0:
+                self.error("Usage: show epg, show interfaces or show vlan.")
+            elif parameters[0] == 'epg':
                 if len(parameters) >= 2:
-                    if parameters[1] in self.epg_names:
+                    if self.known('epg', parameters[1]):
                         epg = parameters[1]
+                    elif self.strict_names:
+                        # fabric sessions of a fan-out skip EPGs they don't have
+                        return
                     else:
                         epg='ALL'
                 else:
                     epg='ALL'
-                self.get_epg_data(epg)
-                self.get_interface_data()
+                if epg == 'ALL':
+                    self.engine.run([(self.get_epg_data, (epg,), {}), (self.get_interface_data, (), {})])
+                else:
+                    # only the leafs the EPG is bound to are needed
+                    self.get_epg_data(epg)
+                    self.get_interface_data(self.epg_nodes())
                 self.print_epgs()
-            elif 'interface' in args:
-                parameters = args.split()
+            elif parameters[0] in ('interface', 'interfaces'):
+                if len(parameters) in (2, 3) and self.strict_names and not self.known('leaf', parameters[1]):
+                    # fabric sessions of a fan-out skip leafs they don't have
+                    return
                 if len(parameters) >= 2:
-                    if (len(parameters) == 2) and (parameters[1] in self.leafs):
-                        self.get_interface_data(parameters[1])
+                    if (len(parameters) == 2) and self.known('leaf', parameters[1]):
+                        self.get_interface_data([parameters[1]])
                         self.print_interface()
-                    elif (len(parameters) == 3) and (parameters[1] in self.leafs):
-                        self.get_interface_data(parameters[1])
-                        self.get_epg_data(epg='ALL')
+                    elif (len(parameters) == 3) and self.known('leaf', parameters[1]):
+                        self.get_interface_data([parameters[1]])
                         try:
-                            idx = int(parameters[1]) * 1000 + int(parameters[2].split('/')[0]) * 100 + \
-                                  int(parameters[2].split('/')[-1])
+                            key = self.interfaces.find(parameters[1], parameters[2])
 
-                            if idx in self.idict:
-                                self.print_interface_details(idx)
+                            if key is not None:
+                                self.get_port_bindings(key)
+                                self.print_interface_details(key)
                             else:
-                                print 'ERROR: Interface is not present on the Node or not a LEAF port', parameters[1]
+                                self.error('ERROR: Interface is not present on the Node or not a LEAF port',
+                                           parameters[1])
                         except Exception as error:
-                            print 'ERROR: ', str(error)
+                            self.error('ERROR: ', str(error))
 
                     else:
-                        print 'ERROR: Incorrect Node or Interface'
+                        self.error('ERROR: Incorrect Node or Interface')
                 else:
                     self.get_interface_data()
                     self.print_interface()
-            elif 'snapshot' in args:
+            elif parameters[0] == 'snapshot':
                 self.print_snapshot()
-            elif 'vlan' in args:
-                parameters = args.split()
-                if len(parameters) == 2 and 'pool' not in parameters[1]:
+            elif parameters[0] == 'vlan':
+                if len(parameters) == 2 and parameters[1] in ('pool', 'pools'):
+                    self.get_vlan_pool()
+                    self.print_vlan_pool()
+                elif len(parameters) == 2 and parameters[1] == 'overlap':
+                    self.get_vlan_pool()
+                    self.print_vlan_overlap()
+                elif len(parameters) == 3 and parameters[1] == 'free':
+                    self.engine.run([(self.get_epg_data, ('ALL',), {}), (self.get_vlan_pool, (), {})])
+                    self.print_vlan_free(parameters[2])
+                elif len(parameters) == 2:
                     try:
-                       vlan_id = int(parameters[1])
-                       if (vlan_id >= 1) and (vlan_id <= 4096):
-                            self.get_epg_data('ALL')
-                            self.get_vlan_pool()
-                            self.vlan_usage(vlan_id)
+                       vlan_range = [int(vlan) for vlan in parameters[1].split('-', 1)]
+                       if (vlan_range[0] >= 1) and (vlan_range[-1] <= 4096) and (vlan_range[0] <= vlan_range[-1]):
+                            self.engine.run([(self.get_epg_data, ('ALL',), {}), (self.get_vlan_pool, (), {})])
+                            if len(vlan_range) == 1:
+                                self.vlan_usage(vlan_range[0])
+                            else:
+                                self.vlan_range_usage(vlan_range[0], vlan_range[1])
                        else:
-                           print 'VLAN needs to be 1-4096'
+                           self.error('VLAN needs to be 1-4096')
                     except Exception as error:
-                       print str(error)
-                elif len(parameters) == 2 and 'pool' in parameters[1]:
-                    self.get_vlan_pool()
-                    self.print_vlan_pool()
+                       self.error(str(error))
                 else:
-                    print 'Usage: show vlan pools or show vlan [VLAN]'
+                    self.error('Usage: show vlan pools, show vlan [VLAN] | [FROM-TO], show vlan free [POOL] or '
+                               'show vlan overlap')
+            else:
+                self.error("Usage: show epg, show interfaces or show vlan.")
         else:
-            print 'Login to a Fabric'
+            self.error('Login to a Fabric')
         return
 
     def complete_config(self, text, line, begidx, endidx):
@@ -231,10 +1612,7 @@ class Apic(Cmd):
                 return CONFIG_CMDS
 
         if begidx == 16 and 'snapshot' in line:
-            if text:
-                return [i for i in CONFIG_SNAPSHOT if i.startswith(text)]
-            else:
-                return CONFIG_SNAPSHOT
+            return [i for i in CONFIG_SNAPSHOT if i.startswith(text)] + self.complete_names('snapshot', text)
 
     def complete_show(self, text, line, begidx, endidx):
 
@@ -245,10 +1623,7 @@ class Apic(Cmd):
                 return SHOW_CMDS
 
         if begidx == 9 and 'epg' in line:
-            if text:
-                return [i for i in self.epg_names if i.startswith(text)]
-            else:
-                return self.epg_names
+            return self.complete_names('epg', text)
         
         if begidx == 10 and 'vlan' in line:
             if text:
@@ -256,18 +1631,86 @@ class Apic(Cmd):
             else:
                 return SHOW_VLAN_CMDS
 
+        if begidx == 15 and 'vlan free' in line:
+            return self.complete_names('pool', text)
+
         if begidx == 15 and 'interface' in line:
-            if text:
-                return [i for i in self.leafs if i.startswith(text)]
-            else:
-                return self.leafs
+            return self.complete_names('leaf', text)
+
+        parameters = line.split()
+        if 'interface' in line and len(parameters) >= 3 and begidx == len(' '.join(parameters[:3])) + 1:
+            return self.complete_interfaces(parameters[2], text)
 
     def complete_login(self, text, line, begidx, endidx):
         if begidx == 6 and 'login' in line:
+            options = list(FABRICS.keys()) + ['ALL', '--offline']
+            if text:
+                return [i for i in options if i.startswith(text)]
+            else:
+                return options
+
+    def do_cache(self, args):
+        """
+        Shows or clears the local cache of APIC query results
+        Usage:
+        cache stats | clear
+        """
+        if 'clear' in args:
+            self.cache.invalidate()
+            self.echo('Cache cleared')
+        else:
+            self.echo('Cached queries:', len(self.cache.entries))
+            self.echo('Cached objects:', self.cache.size, 'of', self.cache.max_mos)
+            self.echo('Hits:', self.cache.hits, 'Misses:', self.cache.misses)
+
+    def complete_cache(self, text, line, begidx, endidx):
+        if begidx == 6:
+            if text:
+                return [i for i in CACHE_CMDS if i.startswith(text)]
+            else:
+                return CACHE_CMDS
+
+    def do_watch(self, args):
+        """
+        Shows EPG or interface information and redraws it whenever the APIC reports a change, until Ctrl-C
+        Usage:
+        watch epg [<epg_name>]
+        watch interface [<node>]
+        """
+        parameters = args.split()
+        if websocket is None:
+            self.error('ERROR: watch needs the websocket-client package')
+        elif not self.can_connect:
+            self.error('Login to a Fabric')
+        elif self.can_connect == 'ALL' or not self.ls:
+            self.error('Login to a single Fabric, watch needs a connection to an APIC')
+        elif not parameters or parameters[0] not in WATCH_CMDS:
+            self.error('Usage: watch epg [EPG] or watch interface [NODE]')
+        else:
+            target = parameters[1] if len(parameters) > 1 else ''
+            if parameters[0] == 'epg':
+                if target and not self.known('epg', target):
+                    self.error('ERROR: EPG not found', target)
+                    return
+                self.watch_epgs(target or 'ALL')
+            else:
+                if target and not self.known('leaf', target):
+                    self.error('ERROR: Incorrect Node', target)
+                    return
+                self.watch_interfaces(target)
+
+    def complete_watch(self, text, line, begidx, endidx):
+        if begidx == 6:
             if text:
-                return [i for i in FABRICS if i.startswith(text)]
+                return [i for i in WATCH_CMDS if i.startswith(text)]
             else:
-                return FABRICS.keys()
+                return WATCH_CMDS
+
+        if begidx == 10 and 'epg' in line:
+            return self.complete_names('epg', text)
+
+        if begidx == 16 and 'interface' in line:
+            return self.complete_names('leaf', text)
 
     def do_quit(self, args):
         """Quits the program."""
@@ -278,54 +1721,468 @@ class Apic(Cmd):
     def emptyline(self):
         pass
 
-    def connect(self):
+    def onecmd(self, line):
+        self.timing.begin(line)
+        self.failed = False
+        try:
+            return Cmd.onecmd(self, line)
+        finally:
+            if self.output_format == 'json':
+                StreamWriter.end_json()
+            command = self.timing.end()
+            if self.show_timing and command and command['command'].strip():
+                self.print_timing(command, sys.stderr)
+
+    def do_stats(self, args):
+        """
+        Shows where the last command spent its time: APIC queries, collecting and rendering
+        Usage:
+        stats [queries]
+        stats export <file> [json|trace]
+        stats clear
+        """
+        parameters = args.split()
+        # earlier stats commands would only show up as empty entries
+        commands = [command for command in self.timing.commands if not command['command'].startswith('stats')]
+        if parameters and parameters[0] == 'clear':
+            self.timing.commands = []
+            self.echo('Timing statistics cleared')
+        elif parameters and parameters[0] == 'export':
+            if len(parameters) not in (2, 3) or parameters[2:] and parameters[2] not in STATS_FORMATS:
+                self.error('Usage: stats export <file> [json|trace]')
+                return
+            if parameters[2:] == ['trace']:
+                data = self.timing.trace_events()
+            else:
+                data = commands
+            try:
+                with open(parameters[1], 'w') as stats_file:
+                    json.dump(data, stats_file, indent=1)
+                self.echo('Exported timing of', len(commands), 'commands to', parameters[1])
+            except Exception as error:
+                self.error('ERROR: failed to export timing statistics', str(error))
+        elif not commands:
+            self.echo('No commands recorded')
+        elif parameters and parameters[0] == 'queries':
+            command = commands[-1]
+            self.echo('Command:', command['command'])
+            y = self.new_table(['CLASS', 'PARENT', 'FILTER', 'PAGE', 'MOS', 'BYTES', 'MS'])
+            for span in sorted(command['spans'], key=lambda span: span['start']):
+                if span['category'] == 'query':
+                    args = span['args']
+                    y.add_row([span['name'], args['parent'], args['filter'], args['page'], args.get('mos', ''),
+                               args.get('bytes', ''), int(span['duration'] * 1000)])
+            y.close()
+        else:
+            self.print_timing(commands[-1])
+
+    def complete_stats(self, text, line, begidx, endidx):
+        if begidx == 6:
+            if text:
+                return [i for i in STATS_CMDS if i.startswith(text)]
+            else:
+                return STATS_CMDS
+
+    def do_profile(self, args):
+        """
+        Runs a command under cProfile and shows the functions it spent most time in. Queries run in worker threads,
+        in the main thread they show up as waits.
+        Usage: profile <command>
+        """
+        if not args:
+            self.error('Usage: profile <command>')
+            return
+        profiler = cProfile.Profile()
+        profiler.runcall(Cmd.onecmd, self, self.precmd(args))
+        stats = pstats.Stats(profiler, stream=sys.stderr if self.output_format != 'table' else sys.stdout)
+        stats.sort_stats('cumulative').print_stats(PROFILE_LINES)
+
+    def print_timing(self, command, stream=None):
+        """Prints the query, collect and render time of a command, totals per class or method"""
+        totals = OrderedDict()
+        for span in sorted(command['spans'], key=lambda span: span['start']):
+            total = totals.setdefault((span['category'], span['name']), [0, 0, 0, 0])
+            total[0] += 1
+            total[1] += span['duration']
+            total[2] = max(total[2], span['duration'])
+            total[3] += span['args'].get('mos', 0)
+
+        columns = ['PHASE', 'NAME', 'CALLS', 'TOTAL MS', 'MAX MS', 'MOS']
+        rows = [[category, name, calls, int(duration * 1000), int(longest * 1000), mos]
+                for (category, name), (calls, duration, longest, mos) in totals.items()]
+        title = 'Command: {0} ({1} ms)'.format(command['command'], int(command['duration'] * 1000))
+        if stream is None:
+            self.echo(title)
+            y = self.new_table(columns)
+            for row in rows:
+                y.add_row(row)
+            y.close()
+        else:
+            y = PrettyTable(columns)
+            for row in rows:
+                y.add_row(row)
+            stream.write(title + '\n' + y.get_string() + '\n')
+
+    def precmd(self, line):
+        # commands with a dash, i.e. export-state, are implemented as do_export_state
+        command, space, rest = line.partition(' ')
+        return command.replace('-', '_') + space + rest
+
+    def new_table(self, columns, context=None):
+        if self.output_format == 'table':
+            return TableWriter(columns, context)
+        if self.output_format == 'capture':
+            return CaptureWriter(self.captured, columns, context)
+        return StreamWriter(self.output_format, columns, context)
+
+    def echo(self, *args):
+        """Prints informational text, kept off stdout when the output is machine readable."""
+        if self.output_format == 'capture':
+            return
+        stream = sys.stdout if self.output_format == 'table' else sys.stderr
+        stream.write(' '.join(str(arg) for arg in args) + '\n')
 
-        self.ls = cobra.mit.session.LoginSession('https://' + self.address, self.username, self.password)
-        self.md = cobra.mit.access.MoDirectory(self.ls)
-        self.md.login()
-        # self.refresh_time_epoch = int(self.ls.refreshTime)
-        self.refresh_time_epoch = int(datetime.datetime.now().strftime('%s'))
-        self.collect_epgs()
-        self.collect_leafs()
+    def error(self, *args):
+        """Prints an error or usage message on stderr and marks the command as failed, for the batch exit code."""
+        self.failed = True
+        if self.strict_names:
+            # the fabric sessions of a fan-out say which fabric failed
+            args = (self.fabric_name + ':', ) + args
+        sys.stderr.write(' '.join(str(arg) for arg in args) + '\n')
 
-    def refresh_connection(self, timeout=90):
+    def connect(self):
+
+        self.use_controller(self.controllers[0])
+        self.echo('Using APIC', self.address, '({0:.0f} ms)'.format(self.controllers[0].latency * 1000))
+        self.engine = QueryEngine(self.reader(), self.fabric_name, self.cache, on_auth_error=self.relogin,
+                                  on_connection_error=self.failover, timing=self.timing)
+        self.load_completions()
+
+    def use_controller(self, controller):
+        self.address = controller.address
+        self.username = controller.username
+        self.password = controller.password
+        self.ls = controller.ls
+        self.md = controller.md
+        self.set_refresh_deadline()
+
+    def reader(self):
+        """Directory the show commands read from, the REST API directly unless REST_READS is turned off"""
+        if REST_READS:
+            return RestDirectory(self.address, self.ls)
+        return self.md
+
+    def failover(self, failed_md):
+        """
+        Switches to the next fastest APIC after failed_md stopped answering, returns False if none of the other APICs
+        accepts a login. Queries failing at the same time only switch once.
+        """
+        with self.session_lock:
+            if self.engine.md is not failed_md:
+                return True
+            failed = self.controllers.pop(0)
+            self.controllers.append(failed)
+            for controller in self.controllers[:-1]:
+                start = time.time()
+                try:
+                    controller.md.login()
+                except Exception as error:
+                    self.error('ERROR', controller.address, str(error))
+                    continue
+                controller.latency = time.time() - start
+                self.echo('APIC', failed.address, 'is not responding, switched to', controller.address)
+                self.controllers.remove(controller)
+                self.controllers.insert(0, controller)
+                self.use_controller(controller)
+                self.engine.md = self.reader()
+                return True
+            return False
+
+    def connect_offline(self, path):
+        if not os.path.isfile(path):
+            self.error('ERROR: fabric state file not found', path)
+            return
         try:
-            current_time_epoch = int(datetime.datetime.now().strftime('%s'))
+            self.md = OfflineDirectory(path)
+        except Exception as error:
+            self.error('ERROR: cannot read fabric state file', str(error))
+            return
+        self.ls = None
+        self.controllers = []
+        self.fabric_name = 'offline:' + os.path.abspath(path)
+        self.set_refresh_deadline()
+        self.engine = QueryEngine(self.md, self.fabric_name, self.cache, timing=self.timing)
+        self.load_completions()
+        self.can_connect = self.md.info.get('fabric', 'OFFLINE')
+        self.echo('Loaded state of Fabric', self.can_connect, 'exported', self.md.info.get('created', ''))
+        self.prompt = 'ACLI({} offline)>'.format(self.can_connect)
+
+    def export_state(self, path):
+        """Writes everything the get_*_data methods query to a fabric state file"""
+        sources = self.engine.lookup_many([
+            ('infraRtAccPortP', 'uni/infra', {}),
+            ('infraNodeBlk', 'uni/infra', {}),
+            ('infraHPortS', 'uni/infra', {'subtree': 'children', 'subtreeClassFilter': PORT_SELECTOR_CHILDREN}),
+            ('fabricPod', '', {}),
+            ('fabricNode', '', {}),
+            ('fvnsVlanInstP', '', {'subtree': 'children', 'subtreeClassFilter': VLAN_POOL_CHILDREN}),
+            ('configSnapshot', '', {}),
+        ])
+        sources += [self.engine.lookup_pages('fvAEPg', '', subtree='children', subtreeClassFilter=EPG_CHILDREN),
+                    self.engine.lookup_pages('l1PhysIf', ''),
+                    self.engine.lookup_pages('ethpmPhysIf', '')]
+        return write_state(path, self.can_connect, sources)
+
+    def load_completions(self):
+        """
+        Loads the names saved for the fabric and refreshes them in the background, commands validating a name which
+        is not known yet wait for the refresh.
+        """
+        self.completions_loaded.clear()
+        path = os.path.join(COMPLETIONS_DIR, 'completions-{0}.json'.format(self.fabric_name)) if self.ls else None
+        self.completions = Completions(path)
+        if path:
+            with self.timing.span('collect', 'saved completions'):
+                self.completions.load()
+
+        def worker():
+            try:
+                self.engine.run([(self.collect_epgs, (), {}), (self.collect_leafs, (), {}),
+                                 (self.collect_pools, (), {})])
+                self.completions.save()
+            except Exception as error:
+                # a background refresh, not the failure of a command
+                print >> sys.stderr, 'ERROR: failed to collect EPG and leaf names', str(error)
+            finally:
+                self.completions_loaded.set()
+
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+
+    def set_refresh_deadline(self):
+        # refresh the token half way through its lifetime, as reported by aaaLogin
+        timeout = int(getattr(self.ls, 'refreshTimeoutSeconds', 0) or 600)
+        self.refresh_deadline = time.time() + timeout / 2
+
+    def relogin(self):
+        with self.session_lock:
+            self.md.login()
+            self.set_refresh_deadline()
+
+    def refresh_connection(self):
+        # data collectors run in parallel threads, only one of them should refresh the token
+        with self.session_lock:
+            try:
+                if time.time() >= self.refresh_deadline:
+                    try:
+                        self.md.reauth()
+                    except Exception as error:
+                        if not is_auth_error(error):
+                            raise
+                        self.md.login()
+                    self.set_refresh_deadline()
+
+                return [0, ]
+
+            except Exception as error:
+                if is_connection_error(error) and self.controllers and self.failover(self.engine.md):
+                    return [0, ]
+                self.error('Lost connection to Fabric', self.can_connect)
+                self.can_connect = ''
+                self.prompt = 'ACLI()>'
+                return [1, ]
+
+    def rest_get(self, path, params=None):
+        """Sends a GET request straight to the APIC REST API with the session token, for what Cobra doesn't cover"""
+        response = requests.get('https://' + self.address + path, params=params, verify=False, timeout=APIC_TIMEOUT,
+                                cookies={'APIC-cookie': self.ls.cookie})
+        response.raise_for_status()
+        return response.json()
+
+    def watch_interfaces(self, node):
+        self.get_interface_data([node] if node else None)
+        if node:
+            node_dns = sorted(set('topology/pod-{0}/node-{1}'.format(*key[:2]) for key in self.interfaces.keys()))
+            paths = ['/api/node/class/{0}/ethpmPhysIf.json'.format(node_dn) for node_dn in node_dns]
+        else:
+            paths = ['/api/node/class/ethpmPhysIf.json']
+        self.watch([(path, {}) for path in paths], self.print_interface)
 
-            if current_time_epoch - self.refresh_time_epoch >= timeout:
-                self.connect()
-            else:
-                self.md.login()
-                self.refresh_time_epoch = current_time_epoch
+    def watch_epgs(self, epg):
+        if epg == 'ALL':
+            self.engine.run([(self.get_epg_data, (epg,), {}), (self.get_interface_data, (), {})])
+            queries = [('/api/node/class/fvRsPathAtt.json', {}), ('/api/node/class/ethpmPhysIf.json', {})]
+        else:
+            # only the leafs the EPG is bound to are needed, as for show epg
+            self.get_epg_data(epg)
+            self.get_interface_data(self.epg_nodes())
+            queries = []
+            for item in self.epgs:
+                epg_dn = 'uni/tn-{0}/ap-{1}/epg-{2}'.format(item['tn'], item['ap'], item['name'])
+                queries.append(('/api/node/mo/{0}.json'.format(epg_dn),
+                                {'query-target': 'children', 'target-subtree-class': 'fvRsPathAtt'}))
+            nodes = set(self.epg_nodes())
+            node_dns = set('topology/pod-{0}/node-{1}'.format(*key[:2]) for key in self.interfaces.keys()
+                           if str(key[1]) in nodes)
+            queries += [('/api/node/class/{0}/ethpmPhysIf.json'.format(node_dn), {}) for node_dn in sorted(node_dns)]
+        self.watch(queries, self.print_epgs)
+
+    def watch(self, queries, draw):
+        """Subscribes to queries and redraws with draw() after each burst of change events, until Ctrl-C"""
+        try:
+            stream = EventStream(self.address, self.ls.cookie, self.rest_get)
+            for path, params in queries:
+                stream.subscribe(path, params)
+        except Exception as error:
+            self.error('ERROR: cannot subscribe to APIC events', str(error))
+            return
 
-            return [0, ]
+        def redraw():
+            if self.output_format == 'table':
+                sys.stdout.write('\033[2J\033[H')
+            self.echo('Fabric', self.can_connect, time.strftime('%H:%M:%S'), '- Ctrl-C to stop')
+            draw()
 
-        except:
-            print 'Lost connection to Fabric', self.can_connect
-            self.can_connect = ''
-            apic.prompt = 'ACLI()>'
-            return [1, ]
+        changed = False
+        refresh_at = time.time() + SUBSCRIPTION_REFRESH
+        try:
+            redraw()
+            while True:
+                try:
+                    event = stream.events.get(timeout=1)
+                except Queue.Empty:
+                    event = ()
+                if event is None:
+                    self.error('Lost connection to APIC events')
+                    break
+                if event:
+                    self.apply_event(*event)
+                    changed = True
+                if changed and stream.events.empty():
+                    redraw()
+                    changed = False
+                if time.time() >= refresh_at:
+                    if self.refresh_connection()[0] == 1:
+                        break
+                    stream.refresh()
+                    refresh_at = time.time() + SUBSCRIPTION_REFRESH
+        except KeyboardInterrupt:
+            pass
+        except Exception as error:
+            self.error('ERROR: watch stopped,', str(error))
+        finally:
+            stream.close()
+
+    def apply_event(self, class_name, attributes):
+        """Applies a changed ethpmPhysIf or fvRsPathAtt to the interface and EPG tables"""
+        # events are parsed JSON, the tables hold str values
+        attributes = str_attributes(attributes)
+        dn = attributes['dn']
+        status = attributes.get('status', '')
+        if class_name == 'ethpmPhysIf':
+            phys = parse_phys_dn(dn)
+            key = port_key(*phys) if phys else None
+            if key in self.interfaces:
+                port = self.interfaces[key]
+                port.set_oper_state(attributes.get('operSt', port.operSt), attributes.get('operSpeed', port.operSpeed),
+                                    attributes.get('operDuplex', port.operDuplex))
+        elif class_name == 'fvRsPathAtt':
+            t_dn = attributes.get('tDn') or split_dn(dn)[-1][len('rspathAtt-['):-1]
+            tn, ap, name = parse_epg_dn(split_dn_parent(dn))
+            for epg in self.epgs:
+                if (epg['tn'], epg['ap'], epg['name']) == (tn, ap, name):
+                    old_paths = [path for path in epg['paths'] if path['tDn'] == t_dn]
+                    paths = [path for path in epg['paths'] if path['tDn'] != t_dn]
+                    if status != 'deleted':
+                        if 'encap' in attributes:
+                            encap = attributes['encap'].replace('vlan-', '')
+                        else:
+                            encap = old_paths[0]['encap'] if old_paths else ''
+                        path = static_path(t_dn, encap)
+                        if path:
+                            paths.append(path)
+                    epg['paths'] = sorted(paths, key=lambda k: k['key'])
+            self.index_paths()
+        # the cached query results are stale now
+        if class_name in WATCH_CACHED_CLASSES:
+            self.cache.invalidate(self.fabric_name, WATCH_CACHED_CLASSES[class_name])
 
     def disconnect(self):
+        # interfaces completed since the login are kept for the next one
+        self.completions.save()
+        # the current APIC is logged out below
+        for controller in self.controllers[1:]:
+            try:
+                controller.md.logout()
+            except:
+                pass
+        self.controllers = []
         try:
             self.md.logout()
         except:
             pass
-        apic.prompt = 'ACLI()>'
+        for session in self.sessions.values():
+            session.disconnect()
+        self.sessions = {}
+        self.prompt = 'ACLI()>'
+
+    def known(self, kind, name):
+        """True if name is in the completions, a name which isn't is checked again once they are refreshed"""
+        if name in self.completions[kind]:
+            return True
+        self.completions_loaded.wait(60)
+        return name in self.completions[kind]
+
+    def complete_names(self, kind, text):
+        names = self.completions[kind].complete(text)
+        if self.sessions:
+            names = sorted(set(names).union(*[session.completions[kind].complete(text)
+                                              for session in self.sessions.values()]))
+        return names
+
+    def complete_interfaces(self, leaf, text):
+        # interfaces of a leaf are fetched the first time they are completed
+        if leaf not in self.completions.interfaces and leaf in self.completions['leaf'] and self.engine:
+            node_dn = self.completions.leaf_dns[leaf]
+            intf_ids = [phys[2] for phys in [parse_phys_dn(str(intf.dn))
+                                             for intf in self.engine.lookup('l1PhysIf', node_dn + '/sys')] if phys]
+            self.completions.set_interfaces(leaf, intf_ids)
+        if leaf in self.completions.interfaces:
+            return self.completions.interfaces[leaf].complete(text)
+        return []
 
     def collect_epgs(self):
-        resp = self.md.lookupByClass('fvAEPg', '')
-        self.epg_names = []
-        for epg in resp:
-            self.epg_names.append(str(epg.name))
+        completions = self.completions
+        audit_filter = 'wcard(aaaModLR.affected,"/epg-")'
+        if completions.stamp and time.time() - completions.updated < COMPLETIONS_MAX_AGE:
+            # EPGs created or deleted since the names were saved
+            records = self.engine.lookup('aaaModLR', '', propFilter=and_filter(
+                audit_filter, 'gt(aaaModLR.created,"{0}")'.format(completions.stamp)),
+                orderBy='aaaModLR.created', pageSize=AUDIT_PAGE_SIZE, page=0)
+            if len(records) < AUDIT_PAGE_SIZE:
+                changes = [(str(record.affected), str(record.ind) == 'deletion') for record in records
+                           if EPG_DN.match(str(record.affected)) and str(record.ind) in ('creation', 'deletion')]
+                completions.update_epgs(changes, str(records[-1].created) if records else completions.stamp)
+                return
+
+        # the stamp is taken first, changes made during the download are applied again next time
+        records = self.engine.lookup('aaaModLR', '', propFilter=audit_filter, orderBy='aaaModLR.created|desc',
+                                     pageSize=1, page=0)
+        resp = self.engine.lookup('fvAEPg', '', propInclude='naming-only')
+        # with no EPG changes in the audit log yet, the next login picks up any change after the epoch
+        completions.set_epgs([str(epg.dn) for epg in resp], str(records[0].created) if records else '0')
 
     def collect_leafs(self):
-        resp = self.md.lookupByClass('fabricNode', '')
-        self.leafs = []
-        for node in resp:
-            if str(node.role) == 'leaf':
-                self.leafs.append(str(node.id))
+        # same query as get_interface_data uses for all leafs, so they share the cached result
+        resp = self.engine.lookup('fabricNode', '', propFilter=eq_filter('fabricNode', 'role', 'leaf'))
+        self.completions.set('leaf_dns', dict((str(node.id), str(node.dn)) for node in resp))
+
+    def collect_pools(self):
+        resp = self.engine.lookup('fvnsVlanInstP', '', propInclude='naming-only')
+        self.completions.set('pool_names', [str(pool.name) for pool in resp])
     
+    @timed('collect')
     def collect_snapshots(self):
 
         result = self.refresh_connection()
@@ -334,8 +2191,9 @@ class Apic(Cmd):
             return
 
         self.snapshots = []
-        snapshots_unsorted = self.md.lookupByClass('configSnapshot', '')
+        snapshots_unsorted = self.engine.lookup('configSnapshot', '')
         self.snapshots = sorted(snapshots_unsorted, key=attrgetter("createTime"), reverse=True)
+        self.completions.set('snapshot_ids', [str(i) for i in range(len(self.snapshots))])
         return    
 
     def create_snapshot(self, description):
@@ -345,6 +2203,10 @@ class Apic(Cmd):
         if result[0] == 1:
             return
 
+        import cobra.mit.request
+        import cobra.model.config
+        import cobra.model.fabric
+        import cobra.model.pol
         pol_uni = cobra.model.pol.Uni('')
         fabric_inst = cobra.model.fabric.Inst(pol_uni)
         cobra.model.config.ExportP(fabric_inst, targetDn='', name='defaultOneTime', adminSt='triggered',
@@ -365,16 +2227,19 @@ class Apic(Cmd):
         if result[0] == 1:
             return
 
-        snapshot = self.snapshots[int(snapshot_id)]
-        snapshot.descr = description
-        c = cobra.mit.request.ConfigRequest()
-        c.addMo(snapshot)
+        import cobra.mit.request
         try:
+            # snapshots may have been read as Records, changes need the Cobra MO
+            snapshot = self.md.lookupByDn(str(self.snapshots[int(snapshot_id)].dn))
+            snapshot.descr = description
+            c = cobra.mit.request.ConfigRequest()
+            c.addMo(snapshot)
             self.md.commit(c)
             return [0, ]
         except:
             return [1, ]
     
+    @timed('collect')
     def get_epg_data(self, epg):
 
         result = self.refresh_connection()
@@ -385,162 +2250,268 @@ class Apic(Cmd):
         self.epgs = []
         if epg:
             if epg == 'ALL':
-                resp = self.md.lookupByClass('fvAEPg', '', subtree='children')
+                resp = self.engine.lookup_pages('fvAEPg', '', subtree='children', subtreeClassFilter=EPG_CHILDREN)
             else:
-                resp = self.md.lookupByClass('fvAEPg', '', propFilter='eq( fvAEPg.name, "{0}")'.format(epg),
-                                             subtree='children')
+                resp = self.engine.lookup('fvAEPg', '', propFilter=epg_filter(epg), subtree='children',
+                                          subtreeClassFilter=EPG_CHILDREN)
             for epg in resp:
                 paths = []
                 tags = []
+                bd = ''
                 name = str(epg.name)
-                tn = str(epg.dn).split('/')[1].replace('tn-', '')
-                ap = str(epg.dn).split('/')[2].replace('ap-', '')
+                tn, ap = parse_epg_dn(str(epg.dn))[:2]
                 if epg.numChildren > 0:
                     for child in epg.children:
-                        if 'RsPathAtt' in str(child.__class__):
-                            encap = str(child.encap).replace('vlan-', '')
-                            if 'protpaths' in str(child.tDn):
-                                protpaths = str(child.tDn).split('/')[2]
-                                vpc = str(child.tDn).split('/')[-1].split('[')[-1][:-1]
-                                path_dict = {'vpc': vpc, 'protpaths': protpaths, 'encap': encap, 'idx': 0}
-                                paths.append(path_dict)
-
-                            elif 'paths' in str(child.tDn):
-                                intf_id = str(child.tDn).split('eth')[-1][:-1]
-                                node = str(child.tDn).split('/')[2].replace('paths-', '')
-                                idx = int(node)*1000 + int(str(intf_id).split('/')[0])*100 +\
-                                    int(str(intf_id).split('/')[-1])
-                                path_dict = {'idx': idx, 'node': node, 'intf_id': intf_id, 'encap': encap}
-                                paths.append(path_dict)
-
-                        elif 'tag' in str(child.dn):
-                            tags.append(str(child.dn).split('/')[-1].replace('tag-', ''))
-
-                        elif 'RsBd' in str(child.__class__):
+                        class_name = child.meta.moClassName
+                        if class_name == 'fvRsPathAtt':
+                            path = static_path(str(child.tDn), str(child.encap).replace('vlan-', ''))
+                            if path:
+                                paths.append(path)
+
+                        elif class_name == 'tagInst':
+                            tags.append(rn_name(str(child.dn)))
+
+                        elif class_name == 'fvRsBd':
                             bd = str(child.tnFvBDName)
 
-                paths_sorted = sorted(paths, key=lambda k: k['idx'])
+                paths_sorted = sorted(paths, key=lambda k: k['key'])
                 epg_dict = {'name': name, 'tn': tn, 'ap': ap, 'bd': bd, 'paths': paths_sorted, 'tags': tags}
                 self.epgs.append(epg_dict)
-    
-    def get_interface_data(self, target_node=''):
+
+        self.index_paths()
+
+    def index_paths(self):
+        # bindings per interface key and per (node, vpc policy group), for interface to EPG lookups
+        path_index = {}
+        for epg in self.epgs:
+            for path in epg['paths']:
+                if 'vpc' in path:
+                    for node in path['nodes']:
+                        path_index.setdefault((node, path['vpc']), []).append((epg, path))
+                else:
+                    path_index.setdefault(path['key'], []).append((epg, path))
+        self.path_index = path_index
+
+    def epg_nodes(self):
+        """Leafs the collected EPGs have static bindings on, both of a vPC"""
+        nodes = set()
+        for epg in self.epgs:
+            for path in epg['paths']:
+                nodes.update(path['nodes'] if 'vpc' in path else [path['node']])
+        return sorted(nodes)
+
+    @timed('collect')
+    def get_port_bindings(self, key):
+        """Collects only the EPGs with a static binding to the port or to the port channel or vPC it is member of"""
+
+        result = self.refresh_connection()
+
+        if result[0] == 1:
+            return
+
+        port = self.interfaces[key]
+        path_filter = eq_filter('fvRsPathAtt', 'tDn',
+                                'topology/pod-{0}/paths-{1}/pathep-[eth{2}]'.format(key[0], port.node, port.intf_id))
+        if key[2] >= 101:
+            # FEX ids start at 101, eth111/1/1 is bound as port 1/1 of FEX 111
+            fex, fex_port = port.intf_id.split('/', 1)
+            path_filter = or_filter(path_filter, eq_filter(
+                'fvRsPathAtt', 'tDn', 'topology/pod-{0}/paths-{1}/extpaths-{2}/pathep-[eth{3}]'.format(
+                    key[0], port.node, fex, fex_port)))
+        if port.policy_group:
+            # the vPC peer is not known here, bundle paths are matched by name and checked for the node below
+            path_filter = or_filter(path_filter, 'wcard(fvRsPathAtt.tDn,"{0}]")'.format(port.policy_group))
+
+        epg_paths = OrderedDict()
+        for binding in self.engine.lookup('fvRsPathAtt', '', propFilter=path_filter):
+            path = static_path(str(binding.tDn), str(binding.encap).replace('vlan-', ''))
+            if not path:
+                continue
+            if path['key'] == key or (path.get('vpc') == port.policy_group and port.node in path.get('nodes', ())):
+                epg_paths.setdefault(split_dn_parent(str(binding.dn)), []).append(path)
+
+        # BDs of the owning EPGs only, in batches to keep the filter short
+        epg_dns = list(epg_paths)
+        queries = []
+        for i in range(0, len(epg_dns), 50):
+            epg_filter = or_filter(*[eq_filter('fvAEPg', 'dn', dn) for dn in epg_dns[i:i + 50]])
+            queries.append(('fvAEPg', '', {'propFilter': epg_filter, 'subtree': 'children',
+                                           'subtreeClassFilter': 'fvRsBd'}))
+        bds = {}
+        for resp in self.engine.lookup_many(queries):
+            for epg in resp:
+                for child in epg.children:
+                    if child.meta.moClassName == 'fvRsBd':
+                        bds[str(epg.dn)] = str(child.tnFvBDName)
+
+        self.epgs = []
+        for epg_dn, paths in epg_paths.items():
+            tn, ap, name = parse_epg_dn(epg_dn)
+            self.epgs.append({'name': name, 'tn': tn, 'ap': ap, 'bd': bds.get(epg_dn, ''), 'paths': paths,
+                              'tags': []})
+        self.index_paths()
+
+    @timed('collect')
+    def get_interface_data(self, target_nodes=None):
+        """Collects the interfaces of the target_nodes leafs, or of every leaf when no list is given"""
 
         result = self.refresh_connection()
 
         if result[0] == 1:
             return
 
-        port_profiles = {}
+        # the port selector map only changes with the access policies, check for that alongside the oper state
+        wait_port_profiles = submit(self.get_port_profiles)
+        if target_nodes is None:
+            # fabric wide interface classes are streamed, their first pages load alongside the other queries
+            intfs = self.engine.lookup_pages('l1PhysIf', '')
+            phy_intfs = self.engine.lookup_pages('ethpmPhysIf', '')
+        # all leafs are cached from the completions, target nodes are picked from them
+        fabric_nodes = self.engine.lookup('fabricNode', '', propFilter=eq_filter('fabricNode', 'role', 'leaf'))
+
+        leaf_nodes = {}
+        for node in fabric_nodes:
+            if target_nodes is None or str(node.id) in target_nodes:
+                leaf_nodes[str(node.dn)] = parse_node_dn(str(node.dn))
+        leaf_ids = set(leaf_nodes.values())
+
+        if target_nodes is not None:
+            intfs = []
+            phy_intfs = []
+            node_queries = []
+            for node_dn in leaf_nodes:
+                node_queries += [('l1PhysIf', node_dn + '/sys', {}), ('ethpmPhysIf', node_dn + '/sys', {})]
+            node_results = self.engine.lookup_many(node_queries)
+            for i in range(0, len(node_results), 2):
+                intfs.extend(node_results[i])
+                phy_intfs.extend(node_results[i + 1])
+
+        # the table is rebuilt on every query, so ports of nodes from earlier commands don't linger
+        interfaces = InterfaceTable()
+        intf_ports = {}
+        for intf in intfs:
+            intf_dn = str(intf.dn)
+            phys = parse_phys_dn(intf_dn)
+            if phys and phys[:2] in leaf_ids:
+                pod, node, intf_id = phys
+                port = Port(node, intf_id, str(intf.portT), str(intf.usage), str(intf.descr))
+                interfaces.add(port_key(pod, node, intf_id), port)
+                intf_ports[intf_dn] = port
+
+        # ethpmPhysIf is the 'phys' child of l1PhysIf, so the parent DN is the join key
+        for phy_intf in phy_intfs:
+            port = intf_ports.get(str(phy_intf.dn).rsplit('/', 1)[0])
+            if port is not None:
+                port.set_oper_state(str(phy_intf.operSt), str(phy_intf.operSpeed), str(phy_intf.operDuplex))
+
+        port_profiles = wait_port_profiles()
+        node_pg_index = {}
+        for key in interfaces.keys():
+            port = interfaces[key]
+            selector = port_profiles.find(*key[1:])
+            if selector:
+                port.set_port_selector(*selector)
+            node_pg_index.setdefault((port.node, port.policy_group), []).append(key)
+
+        intf_ids = {}
+        for key in interfaces.keys():
+            intf_ids.setdefault(interfaces[key].node, []).append(interfaces[key].intf_id)
+        for node, ids in intf_ids.items():
+            self.completions.set_interfaces(node, ids)
+
+        self.interfaces = interfaces
+        self.node_pg_index = node_pg_index
+        self.vpc_index = {}
+
+    def infra_change_stamp(self):
+        """Returns the id of the latest audit record for uni/infra, it changes with every access policy change"""
+        records = self.engine.lookup('aaaModLR', '', propFilter='wcard(aaaModLR.affected,"uni/infra/")',
+                                     orderBy='aaaModLR.created|desc', pageSize=1, page=0)
+        return str(records[0].id) if records else ''
+
+    @timed('collect')
+    def get_port_profiles(self):
+        """
+        Returns the map of port selectors and policy groups of the access policies. The map is kept per fabric and only
+        rebuilt when the access policies change, or after the TTL of the infra classes without audit records.
+        """
+        stamp = self.infra_change_stamp()
+        fabric_name = self.fabric_name
+        if fabric_name in self.port_profiles:
+            known_stamp, port_profiles, expires = self.port_profiles[fabric_name]
+            if stamp and stamp == known_stamp:
+                return port_profiles
+            # the audit log can't be read, has rolled over or isn't in the offline state, changes are unknown
+            if not stamp and time.time() < expires:
+                return port_profiles
+            for class_name in INFRA_CONFIG_CLASSES:
+                self.cache.invalidate(fabric_name, class_name)
+
+        queries = [('infraRtAccPortP', 'uni/infra', {'propInclude': 'naming-only'}),
+                   ('infraNodeBlk', 'uni/infra', {'propInclude': 'config-only'}),
+                   ('infraHPortS', 'uni/infra', {'subtree': 'children', 'subtreeClassFilter': PORT_SELECTOR_CHILDREN})]
+        acc_port_profiles, node_blocks, port_selectors = self.engine.lookup_many(queries)
+
         port_to_switch_prof_map = {}
 
-        resp = self.md.lookupByClass('infraRtAccPortP', 'uni/infra')
-        for item in resp:
-            sw_sel = str(item.tDn).split('/')[2].replace('nprof-', '')
-            int_sel = str(item.dn).split('/')[2].replace('accportprof-', '')
+        for item in acc_port_profiles:
+            sw_sel = parse_infra_dn(str(item.tDn))
+            int_sel = parse_infra_dn(str(item.dn))
 
             port_to_switch_prof_map.setdefault(int_sel, []).append(sw_sel)
 
-        resp = self.md.lookupByClass('infraNodeBlk', 'uni/infra')
-
         switch_prof_leaves = {}
 
-        for item in resp:
-
-            sw_sel = str(item.dn).split('/')[2].replace('nprof-', '')
-            for node in range(int(item.from_), int(item.to_) + 1):
-                switch_prof_leaves.setdefault(sw_sel, []).append(node)
+        for item in node_blocks:
 
-        resp = self.md.lookupByClass('infraHPortS', 'uni/infra', subtree='children')
+            sw_sel = parse_infra_dn(str(item.dn))
+            switch_prof_leaves.setdefault(sw_sel, []).append((int(item.from_), int(item.to_)))
 
         access_port_selectors = {}
 
-        for item in resp:
+        for item in port_selectors:
 
-            isl = str(item.dn).split('/')[2].replace('accportprof-', '')
+            isl = parse_infra_dn(str(item.dn))
 
             hport_name = str(item.name)
-            interfaces = []
             if item.numChildren > 0:
                 pol_grp = ''
+                ranges = []
                 for child in item.children:
 
-                    if 'RsAccBaseGrp' in str(child.__class__):
-                        pol_grp = str(child.tDn).split('-', 1)[-1]
-                    elif 'PortBlk' in str(child.__class__):
-                        for intf in range(int(child.fromPort), int(child.toPort) + 1):
-                            intf_name = '1/' + str(intf)
-                            interfaces.append(intf_name)
+                    if child.meta.moClassName == 'infraRsAccBaseGrp':
+                        pol_grp = rn_name(str(child.tDn))
+                    elif child.meta.moClassName == 'infraPortBlk':
+                        ranges.append((int(child.fromCard), int(child.toCard), int(child.fromPort), int(child.toPort),
+                                       0, 0))
+                    elif child.meta.moClassName == 'infraSubPortBlk':
+                        ranges.append((int(child.fromCard), int(child.toCard), int(child.fromPort), int(child.toPort),
+                                       int(child.fromSubPort), int(child.toSubPort)))
 
-                access_port_selectors.setdefault(isl, []).append({'hport_name' : hport_name, 'policy_group': pol_grp,
-                                                'interfaces': interfaces})
+                access_port_selectors.setdefault(isl, []).extend(
+                    port_range + (hport_name, pol_grp) for port_range in ranges)
 
+        port_profiles = PortSelectorMap()
         for port_selector in access_port_selectors:
-            if port_selector in port_to_switch_prof_map:
-                for port_selector_item in access_port_selectors[port_selector]:
-                    policy_group = port_selector_item['policy_group']
-                    port_sr_name = port_selector_item['hport_name']
-                    nodes = []
-                    for sw_sel in port_to_switch_prof_map[port_selector]:
-                        if sw_sel in switch_prof_leaves:
-                            for node in switch_prof_leaves[sw_sel]:
-                                nodes.append(node)
-
-                    if nodes:
-                        for node in set(nodes):
-                            for intf in set(port_selector_item['interfaces']):
-                                hport_dict = {}
-                                key = int(node)*1000 + int(intf.split('/')[0])*100 + int(intf.split('/')[-1])
-                                hport_dict['policy_group'] = policy_group
-                                hport_dict['port_sr_name'] = port_sr_name
-                                port_profiles[key] = hport_dict
-
-        pods = self.md.lookupByClass('fabricPod', parentDn='topology')
-        leaf_nodes = []
-        for pod in pods:
-            if target_node:
-                nodes = self.md.lookupByClass('fabricNode', propFilter='eq(fabricNode.id, "{0}")'.format(target_node),
-                                              parentDn=pod.dn)
-            else:
-                nodes = self.md.lookupByClass('fabricNode', parentDn=pod.dn)
+            for sw_sel in port_to_switch_prof_map.get(port_selector, []):
+                for from_node, to_node in switch_prof_leaves.get(sw_sel, []):
+                    port_profiles.add(from_node, to_node, access_port_selectors[port_selector])
+
+        ttl = min(CACHE_TTL.get(class_name, CACHE_DEFAULT_TTL) for class_name in INFRA_CONFIG_CLASSES)
+        self.port_profiles[fabric_name] = (stamp, port_profiles, time.time() + ttl)
+        return port_profiles
+
+    def vpc_members(self, nodes, policy_group):
+        """Returns the interface keys of port channel or vPC policy_group on nodes, i.e. ('101', '102')"""
+        index_key = (nodes, policy_group)
+        if index_key not in self.vpc_index:
+            keys = []
             for node in nodes:
-                if node.role == 'leaf':
-                    leaf_nodes.append(node.rn)
-            
-            intfs = self.md.lookupByClass('l1PhysIf', parentDn='')
-            if intfs:
-                for intf in intfs:
-                    node = str(intf.dn).split('/')[2]
-                    if node in leaf_nodes:
-                        intf_id = str(intf.id).strip('eth')
-                        idx = int(str(node).split('-')[-1])*1000 + int(intf_id.split('/')[0])*100 +\
-                            int(intf_id.split('/')[-1])
-                        self.idict[idx] = {'node': str(node), 'intf_id': intf_id, 'portT': str(intf.portT),
-                                           'usage': str(intf.usage), 'descr': str(intf.descr), 'operSt': '',
-                                           'operSpeed': '', 'operDuplex': ''}
-
-                phy_intfs = self.md.lookupByClass('ethpmPhysIf', parentDn='')
-                 
-                for phy_intf in phy_intfs:
-                    node = str(phy_intf.dn).split('/')[2]
-                    if node in leaf_nodes:
-                        match = re.search('\[(eth\d+/\d+)\]', str(phy_intf.dn))
-                        if match:
-                            phy_intf_id = match.group(1).strip('eth')
-                            search_idx = int(str(node).split('-')[-1])*1000 + int(phy_intf_id.split('/')[0])*100 +\
-                                int(phy_intf_id.split('/')[-1])
-                            if search_idx in self.idict:
-                                self.idict[search_idx]['operSt'] = str(phy_intf.operSt)
-                                self.idict[search_idx]['operSpeed'] = str(phy_intf.operSpeed)
-                                self.idict[search_idx]['operDuplex'] = str(phy_intf.operDuplex)
-    
-        for key in self.idict:
-            if key in port_profiles:
-                self.idict[key]['port_sr_name'] = port_profiles[key]['port_sr_name']
-                self.idict[key]['policy_group'] = port_profiles[key]['policy_group']
-            else:
-                self.idict[key]['port_sr_name'] = ''
-                self.idict[key]['policy_group'] = ''
-   
+                keys.extend(self.node_pg_index.get((node, policy_group), []))
+            self.vpc_index[index_key] = sorted(keys)
+        return self.vpc_index[index_key]
+
+    @timed('collect')
     def get_vlan_pool(self):
 
         result = self.refresh_connection()
@@ -549,185 +2520,173 @@ class Apic(Cmd):
             return
 
         self.vlan_pools = []
-        resp = self.md.lookupByClass('fvnsVlanInstP', '', subtree='children')
+        resp = self.engine.lookup('fvnsVlanInstP', '', subtree='children', subtreeClassFilter=VLAN_POOL_CHILDREN)
         for inst in resp:
             name = str(inst.name)
             alloc = str(inst.allocMode)
             domains = []
             if inst.numChildren > 0:
                 for child in inst.children:
-                    if 'RtVlanNs' in str(child.__class__):
-                        domains.append(str(child.tDn).split('uni/')[1])
+                    if child.meta.moClassName == 'fvnsRtVlanNs':
+                        domains.append('/'.join(split_dn(str(child.tDn))[1:]))
                 for child in inst.children:
-                    if 'EncapBlk' in str(child.__class__):
-                        from_vlan = int(str(child.dn).split('from-[')[1].split(']')[0].replace('vlan-', ''))
-                        to_vlan = int(str(child.to).replace('vlan-', ''))
+                    if child.meta.moClassName == 'fvnsEncapBlk':
+                        from_vlan, to_vlan = parse_encap_block_dn(str(child.dn))
                         self.vlan_pools.append({'name': name, 'alloc': alloc, 'domains': domains,
                                                 'from_vlan': from_vlan, 'to_vlan': to_vlan})
  
+    def get_vlan_index(self):
+        if not self.vlan_index or not self.vlan_index.is_current(self.vlan_pools, self.epgs):
+            self.vlan_index = VlanIndex(self.vlan_pools, self.epgs)
+        return self.vlan_index
+
+    @timed('render')
     def vlan_usage(self, vlan):
-        if self.vlan_pools:
-            print 'VLAN:', vlan
-
-            y = PrettyTable(
-                ['POOL NAME', 'ALLOCATION', 'FROM', 'TO', 'DOMAINS'])
-            y.align = "l"
-            y.vertical_char = ' '
-            y.junction_char = ' '
-
-            for item in self.vlan_pools:
-                if (int(vlan) >= item['from_vlan']) and (int(vlan) <= item['to_vlan']):
-                    name = item['name']
-                    alloc = item['alloc']
-                    from_vlan = item['from_vlan']
-                    to_vlan = item['to_vlan']
-                    domains = str(item['domains'])[1:-2]
-                    y.add_row([name, alloc, from_vlan, to_vlan, domains])
-        print(y)
-
-        if self.epgs:
-            print '\n'
-            y = PrettyTable(
-                ['TENANT', 'APP_PROFILE', 'EPG', 'TAGS'])
-            y.align = "l"
-            y.vertical_char = ' '
-            y.junction_char = ' '
+        vlan_index = self.get_vlan_index()
+        self.echo('VLAN:', vlan)
 
-            for epg in self.epgs:
-                vlan_used = False
-                for path in epg['paths']:
-                    if str(vlan) == path['encap']:
-                        vlan_used = True
-                
-                if vlan_used:
-                    tenant = epg['tn']
-                    ap_profile = epg['ap']
-                    epg_name = epg['name']
-                    tags = epg['tags']
-
-                    y.add_row([tenant, ap_profile, epg_name, tags])
-        print(y)
-       
+        y = self.new_table(['POOL NAME', 'ALLOCATION', 'FROM', 'TO', 'DOMAINS'], OrderedDict([('VLAN', vlan)]))
+
+        for item in vlan_index.pool_blocks(vlan):
+            name = item['name']
+            alloc = item['alloc']
+            from_vlan = item['from_vlan']
+            to_vlan = item['to_vlan']
+            domains = str(item['domains'])[1:-1]
+            y.add_row([name, alloc, from_vlan, to_vlan, domains])
+        y.close()
+
+        self.echo('\n')
+        y = self.new_table(['TENANT', 'APP_PROFILE', 'EPG', 'TAGS'], OrderedDict([('VLAN', vlan)]))
+
+        for epg in vlan_index.epgs_using(vlan):
+            tenant = epg['tn']
+            ap_profile = epg['ap']
+            epg_name = epg['name']
+            tags = epg['tags']
+
+            y.add_row([tenant, ap_profile, epg_name, tags])
+        y.close()
+
+    @timed('render')
+    def vlan_range_usage(self, from_vlan, to_vlan):
+        vlan_index = self.get_vlan_index()
+        self.echo('VLAN:', '{0}-{1}'.format(from_vlan, to_vlan))
+
+        y = self.new_table(['POOL NAME', 'ALLOCATION', 'FROM', 'TO', 'DOMAINS'])
+
+        for item in vlan_index.range_blocks(from_vlan, to_vlan):
+            domains = str(item['domains'])[1:-1]
+            y.add_row([item['name'], item['alloc'], item['from_vlan'], item['to_vlan'], domains])
+        y.close()
+
+        self.echo('\n')
+        y = self.new_table(['VLAN', 'TENANT', 'APP_PROFILE', 'EPG', 'TAGS'])
+
+        for vlan in range(from_vlan, to_vlan + 1):
+            for epg in vlan_index.epgs_using(vlan):
+                y.add_row([vlan, epg['tn'], epg['ap'], epg['name'], epg['tags']])
+        y.close()
+
+    @timed('render')
+    def print_vlan_free(self, pool_name):
+        vlan_index = self.get_vlan_index()
+        pool_keys = sorted(key for key in vlan_index.pools if key[0] == pool_name)
+        if not pool_keys:
+            self.error('ERROR: VLAN pool not found', pool_name)
+            return
+
+        y = self.new_table(["NAME", "ALLOCATION", "FROM", "TO", "FREE"])
+
+        for pool_key in pool_keys:
+            for from_vlan, to_vlan in vlan_index.free_ranges(pool_key):
+                y.add_row([pool_key[0], pool_key[1], from_vlan, to_vlan, to_vlan - from_vlan + 1])
+        y.close()
+
+    @timed('render')
+    def print_vlan_overlap(self):
+        vlan_index = self.get_vlan_index()
+
+        y = self.new_table(["DOMAIN", "POOL", "OVERLAPPING POOL", "FROM", "TO"])
+
+        for domain, pool_a, pool_b, from_vlan, to_vlan in vlan_index.overlaps():
+            y.add_row([domain, '-'.join(pool_a), '-'.join(pool_b), from_vlan, to_vlan])
+        y.close()
+
+    @timed('render')
     def print_epgs(self):
         for epg in self.epgs:
-            print '\n'
-            print 'TN:', epg['tn']
-            print 'AP:', epg['ap']
-            print 'EPG:', epg['name']
-            print 'TAG:', epg['tags']
-            print 'BD:', epg['bd']
-
-            y = PrettyTable(
-                ['NODE', 'INTERFACE', 'VLAN', 'TOPOLOGY', 'USAGE', 'STATE', 'SPEED', 'PORT_SR_NAME',
-                                  'POLICY_GROUP'])
-            y.align = "l"
-            y.vertical_char = ' '
-            y.junction_char = ' '
+            self.echo('\n')
+            self.echo('TN:', epg['tn'])
+            self.echo('AP:', epg['ap'])
+            self.echo('EPG:', epg['name'])
+            self.echo('TAG:', epg['tags'])
+            self.echo('BD:', epg['bd'])
+
+            context = OrderedDict([('TENANT', epg['tn']), ('APP_PROFILE', epg['ap']), ('EPG', epg['name']),
+                                   ('TAGS', epg['tags']), ('BD', epg['bd'])])
+            y = self.new_table(['NODE', 'INTERFACE', 'VLAN', 'TOPOLOGY', 'USAGE', 'STATE', 'SPEED', 'PORT_SR_NAME',
+                                'POLICY_GROUP'], context)
 
             for path in epg['paths']:
                 if 'vpc' in path:
-                    for idx in self.idict:
-                        if (path['vpc'] == self.idict[idx]['policy_group']) and (str(idx)[:3] in path['protpaths']):
-                            node = self.idict[idx]['node'].replace('node-', '')
-                            intf_id = self.idict[idx]['intf_id']
-                            port_t = self.idict[idx]['portT']
-                            usage = self.idict[idx]['usage']
-                            oper_st = self.idict[idx]['operSt']
-                            oper_speed = self.idict[idx]['operSpeed']
-                            port_sr_name = self.idict[idx]['port_sr_name']
-                            policy_group = self.idict[idx]['policy_group']
-                            vlan = path['encap']
-                            y.add_row([node, intf_id, vlan, port_t, usage, oper_st, oper_speed, port_sr_name,
-                                       policy_group])
-
-                elif path['idx'] in self.idict:
-                    key = path['idx']
-                    node = self.idict[key]['node'].replace('node-', '')
-                    intf_id = self.idict[key]['intf_id']
-                    port_t = self.idict[key]['portT']
-                    usage = self.idict[key]['usage']
-                    oper_st = self.idict[key]['operSt']
-                    oper_speed = self.idict[key]['operSpeed']
-                    port_sr_name = self.idict[key]['port_sr_name']
-                    policy_group = self.idict[key]['policy_group']
+                    keys = self.vpc_members(path['nodes'], path['vpc'])
+                elif path['key'] in self.interfaces:
+                    keys = [path['key']]
+                else:
+                    keys = []
+                for key in keys:
+                    port = self.interfaces[key]
                     vlan = path['encap']
-                    y.add_row([node, intf_id, vlan, port_t, usage, oper_st, oper_speed, port_sr_name,
-                               policy_group])
+                    y.add_row([port.node, port.intf_id, vlan, port.portT, port.usage, port.operSt, port.operSpeed,
+                               port.port_sr_name, port.policy_group])
 
-            print(y)
+            y.close()
 
+    @timed('render')
     def print_interface(self):
-        print '* - flag indicates configured but not mapped to any EPG interfaces'
+        self.echo('* - flag indicates configured but not mapped to any EPG interfaces')
 
-        y = PrettyTable(["F", "NODE", "INTERFACE", "TOPOLOGY", "USAGE", "STATE", "SPEED", "PORT_SR_NAME",
-                         "POLICY_GROUP"])
-        y.align = "l"
-        y.vertical_char = ' '
-        y.junction_char = ' '
+        y = self.new_table(["F", "NODE", "INTERFACE", "TOPOLOGY", "USAGE", "STATE", "SPEED", "PORT_SR_NAME",
+                            "POLICY_GROUP"])
 
-        for key in sorted(self.idict):
+        for key in self.interfaces.keys():
             flag = ''
-            node = self.idict[key]['node'].replace('node-', '')
-            intf_id = self.idict[key]['intf_id']
-            port_t = self.idict[key]['portT']
-            usage = self.idict[key]['usage']
-            oper_st = self.idict[key]['operSt']
-            oper_speed = self.idict[key]['operSpeed']
-            port_sr_name = self.idict[key]['port_sr_name']
-            policy_group = self.idict[key]['policy_group']
-            if ('discovery' in usage) and (port_sr_name or policy_group):
+            port = self.interfaces[key]
+            if ('discovery' in port.usage) and (port.port_sr_name or port.policy_group):
                 flag = '*'
-            y.add_row([flag, node, intf_id, port_t, usage, oper_st, oper_speed, port_sr_name, policy_group])
-        print(y)
+            y.add_row([flag, port.node, port.intf_id, port.portT, port.usage, port.operSt, port.operSpeed,
+                       port.port_sr_name, port.policy_group])
+        y.close()
 
+    @timed('render')
     def print_interface_details(self, key):
-        print '* - flag indicates configured but not mapped to any EPG interfaces'
+        self.echo('* - flag indicates configured but not mapped to any EPG interfaces')
 
-        y = PrettyTable(["F", "NODE", "INTERFACE", "TOPOLOGY", "USAGE", "STATE", "SPEED", "PORT_SR_NAME",
-                         "POLICY_GROUP"])
-        y.align = "l"
-        y.vertical_char = ' '
-        y.junction_char = ' '
+        y = self.new_table(["F", "NODE", "INTERFACE", "TOPOLOGY", "USAGE", "STATE", "SPEED", "PORT_SR_NAME",
+                            "POLICY_GROUP"])
 
         flag = ''
-        node = self.idict[key]['node'].replace('node-', '')
-        intf_id = self.idict[key]['intf_id']
-        port_t = self.idict[key]['portT']
-        usage = self.idict[key]['usage']
-        oper_st = self.idict[key]['operSt']
-        oper_speed = self.idict[key]['operSpeed']
-        port_sr_name = self.idict[key]['port_sr_name']
-        policy_group = self.idict[key]['policy_group']
-        if ('discovery' in usage) and (port_sr_name or policy_group):
+        port = self.interfaces[key]
+        if ('discovery' in port.usage) and (port.port_sr_name or port.policy_group):
             flag = '*'
-        y.add_row([flag, node, intf_id, port_t, usage, oper_st, oper_speed, port_sr_name, policy_group])
-        print(y)
+        y.add_row([flag, port.node, port.intf_id, port.portT, port.usage, port.operSt, port.operSpeed,
+                   port.port_sr_name, port.policy_group])
+        y.close()
 
-        print '\n EPG Binding Info: \n'
+        self.echo('\n EPG Binding Info: \n')
 
-        y = PrettyTable(["TENANT", "APP PROFILE", "EPG", "BD", "VLAN_ENCAP"])
-        y.align = "l"
-        y.vertical_char = ' '
-        y.junction_char = ' '
+        y = self.new_table(["TENANT", "APP PROFILE", "EPG", "BD", "VLAN_ENCAP"])
 
-        for epg in self.epgs:
-            for path in epg['paths']:
-                if 'vpc' in path:
-                    if (path['vpc'] == self.idict[key]['policy_group']) and (str(key)[:3] in path['protpaths']):
-                        vlan = path['encap']
-                        y.add_row([epg['tn'], epg['ap'], epg['name'], epg['bd'], vlan])
-
-                elif path['idx'] == key:
-                    vlan = path['encap']
-                    y.add_row([epg['tn'], epg['ap'], epg['name'], epg['bd'], vlan])
-        print (y)
+        bindings = self.path_index.get(key, []) + self.path_index.get((port.node, port.policy_group), [])
+        for epg, path in bindings:
+            vlan = path['encap']
+            y.add_row([epg['tn'], epg['ap'], epg['name'], epg['bd'], vlan])
+        y.close()
 
+    @timed('render')
     def print_vlan_pool(self):
-        y = PrettyTable(["NAME", "ALLOCATION", "FROM", "TO", "DOMAINS"])
-        y.align = "l"
-
-        y.vertical_char = ' '
-        y.junction_char = ' '
+        y = self.new_table(["NAME", "ALLOCATION", "FROM", "TO", "DOMAINS"])
         for item in self.vlan_pools:
             name = item['name']
             alloc = item['alloc']
@@ -735,14 +2694,12 @@ class Apic(Cmd):
             to_vlan = item['to_vlan']
             domains = str(item['domains'])[1:-1]
             y.add_row([name, alloc, from_vlan, to_vlan, domains])
-        print(y)
+        y.close()
 
+    @timed('render')
     def print_snapshot(self):
         self.collect_snapshots()
-        y = PrettyTable(["ID", "TRIGGER", "TIME", "DESCRIPTION" ])
-        y.align = "l"
-        y.vertical_char = ' '
-        y.junction_char = ' '
+        y = self.new_table(["ID", "TRIGGER", "TIME", "DESCRIPTION" ])
 
 
         snapshot_id = 0
@@ -762,18 +2719,239 @@ class Apic(Cmd):
             y.add_row([snapshot_id, trigger, snapshot_time, descr])
             snapshot_id += 1
 
-        print(y)
+        y.close()
 
  
+
+class ThreadOutput(object):
+    """Stands in for sys.stdout or sys.stderr in the daemon, so the text a command prints goes to its client."""
+
+    def __init__(self, default):
+        self.default = default
+        self.local = threading.local()
+
+    def redirect(self, stream):
+        self.local.stream = stream
+
+    def current(self):
+        return getattr(self.local, 'stream', None)
+
+    def write(self, text):
+        (getattr(self.local, 'stream', None) or self.default).write(text)
+
+    def flush(self):
+        (getattr(self.local, 'stream', None) or self.default).flush()
+
+
+class DaemonHandler(SocketServer.StreamRequestHandler):
+    """A client connection, each request is a JSON line answered with a JSON line."""
+
+    def handle(self):
+        for line in iter(self.rfile.readline, ''):
+            try:
+                request = json.loads(line)
+            except ValueError:
+                response = {'output': '', 'messages': '', 'error': 'ERROR: request is not JSON'}
+            else:
+                response = self.server.run(request)
+            self.wfile.write(json.dumps(response) + '\n')
+            self.wfile.flush()
+
+
+class Daemon(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    """
+    Keeps a logged in session per fabric, with its cache and tables, and runs the commands clients send over a Unix
+    socket. Commands on the same fabric run one at a time, commands on different fabrics in parallel.
+    """
+    daemon_threads = True
+
+    def __init__(self, path, fabric_names):
+        self.path = path
+        # a socket in the working directory has no directory to create
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory, 0700)
+        if os.path.exists(path):
+            # a socket left behind by a daemon which didn't shut down cleanly is replaced
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(path)
+                listening = True
+            except socket.error:
+                listening = False
+            probe.close()
+            if listening:
+                raise socket.error('a daemon is already listening on ' + path)
+            os.remove(path)
+
+        self.sessions = {}
+        self.credentials = {}
+        self.locks = {}
+        # credentials are collected first, prompts can't be answered from parallel threads
+        for name in fabric_names:
+            session = Apic()
+            self.credentials[name] = session.fabric_credentials(name)
+            self.sessions[name] = session
+            self.locks[name] = threading.Lock()
+        run_parallel([(session.connect_fabric, (name, self.credentials[name]), {})
+                      for name, session in self.sessions.items()])
+        for name in fabric_names:
+            if self.sessions[name].can_connect:
+                print 'Established connection to APIC in', name
+            else:
+                print 'Cannot connect to APIC in', name, ', retrying on the first request'
+
+        SocketServer.UnixStreamServer.__init__(self, path, DaemonHandler)
+        # the sessions are logged in, only the user running the daemon may use them
+        os.chmod(path, 0600)
+        sys.stdout = ThreadOutput(sys.stdout)
+        sys.stderr = ThreadOutput(sys.stderr)
+
+    def run(self, request):
+        """Runs a request's command on its fabric session and returns what the command printed"""
+        fabric = str(request.get('fabric', ''))
+        command = str(request.get('command', '')).strip()
+        output_format = request.get('format', 'table')
+        if fabric not in self.sessions:
+            return {'output': '', 'messages': '', 'error': 'ERROR: Fabric not served by the daemon ' + fabric}
+        if command.split(' ', 1)[0] not in DAEMON_CMDS:
+            return {'output': '', 'messages': '', 'error': 'ERROR: the daemon only runs show and stats commands'}
+        if '--fabrics' in command.split():
+            # other fabrics would prompt for credentials on the daemon's terminal, send a request per fabric instead
+            return {'output': '', 'messages': '', 'error': 'ERROR: --fabrics is not supported, use -f per fabric'}
+        if output_format not in OUTPUT_FORMATS:
+            return {'output': '', 'messages': '', 'error': 'ERROR: unknown output format ' + str(output_format)}
+
+        output = StringIO()
+        messages = StringIO()
+        with self.locks[fabric]:
+            session = self.sessions[fabric]
+            if not session.can_connect:
+                session.connect_fabric(fabric, self.credentials[fabric])
+                if not session.can_connect:
+                    return {'output': '', 'messages': '', 'error': 'Cannot connect to APIC in ' + fabric}
+            session.output_format = output_format
+            StreamWriter.state.header = None
+            sys.stdout.redirect(output)
+            sys.stderr.redirect(messages)
+            try:
+                session.onecmd(session.precmd(command))
+                error = ''
+            except Exception as exception:
+                error = 'ERROR: ' + str(exception)
+            finally:
+                sys.stdout.redirect(None)
+                sys.stderr.redirect(None)
+            # the next command on the fabric resets it
+            failed = session.failed
+        return {'output': output.getvalue(), 'messages': messages.getvalue(), 'error': error, 'failed': failed}
+
+    def close(self):
+        self.server_close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        for session in self.sessions.values():
+            session.disconnect()
+
+
+def send_commands(path, fabric, commands, output_format):
+    """Runs commands on a fabric session of the daemon listening on path, returns False if any of them failed"""
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect(path)
+    reader = client.makefile('r')
+    writer = client.makefile('w')
+    succeeded = True
+    try:
+        for command in commands:
+            writer.write(json.dumps({'fabric': fabric, 'command': command, 'format': output_format}) + '\n')
+            writer.flush()
+            response = json.loads(reader.readline())
+            sys.stdout.write(response['output'])
+            sys.stderr.write(response['messages'])
+            if response['error']:
+                print >> sys.stderr, response['error']
+            if response['error'] or response.get('failed'):
+                succeeded = False
+    finally:
+        client.close()
+    return succeeded
+
+
+IMPORTED = time.time()
+
+
 if __name__ == '__main__':
     requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
     requests.packages.urllib3.disable_warnings(InsecurePlatformWarning)
     requests.packages.urllib3.disable_warnings(SNIMissingWarning)
+
+    parser = argparse.ArgumentParser(description='Command line shell for Cisco ACI APIC')
+    parser.add_argument('-f', '--fabric', help='login to FABRIC on start')
+    parser.add_argument('-c', '--command', action='append', default=[],
+                        help='run COMMAND and exit, can be repeated to run several commands over one session')
+    parser.add_argument('--file', help='run the commands in FILE, one per line, and exit')
+    parser.add_argument('--format', choices=OUTPUT_FORMATS, default='table', help='output format, default table')
+    parser.add_argument('--timing', action='store_true',
+                        help='print the time spent in APIC queries, collecting and rendering after each command')
+    parser.add_argument('--serve', action='store_true',
+                        help='run as a daemon keeping sessions to all fabrics, or to FABRIC, for --daemon clients')
+    parser.add_argument('--daemon', action='store_true',
+                        help='run the commands on the FABRIC session of a running daemon instead of logging in')
+    parser.add_argument('--socket', default=DAEMON_SOCKET, help='Unix socket of the daemon, default ' + DAEMON_SOCKET)
+    options = parser.parse_args()
+
+    commands = list(options.command)
+    if options.file:
+        with open(options.file) as commands_file:
+            commands += [line.strip() for line in commands_file if line.strip() and not line.startswith('#')]
+
+    if options.serve:
+        try:
+            daemon = Daemon(options.socket, [options.fabric] if options.fabric else sorted(FABRICS))
+        except (socket.error, OSError) as error:
+            sys.exit('ERROR: cannot start the daemon, ' + str(error))
+        print 'Serving on', options.socket
+        try:
+            daemon.serve_forever()
+        except KeyboardInterrupt:
+            print "\nINFO: ACLI daemon was interrupted by Ctrl-C"
+        finally:
+            daemon.close()
+        sys.exit(0)
+
+    if options.daemon:
+        if not options.fabric or not commands:
+            parser.error('--daemon needs --fabric and commands to run')
+        try:
+            sys.exit(0 if send_commands(options.socket, options.fabric, commands, options.format) else 1)
+        except socket.error as error:
+            sys.exit('ERROR: cannot reach the daemon on {0}, {1}'.format(options.socket, error))
+
     try:
         apic = Apic()
+        # start-up is timed like a command, up to the first prompt or batch command
+        apic.timing.begin('startup', STARTED)
+        apic.timing.record('startup', 'imports', STARTED, IMPORTED - STARTED)
         apic.prompt = 'ACLI()>'
-        apic.cmdloop('Starting ACLI...')
+        apic.output_format = options.format
+        apic.show_timing = options.timing
+        if options.fabric:
+            with apic.timing.span('startup', 'login'):
+                apic.do_login(options.fabric)
+        startup = apic.timing.end()
+        if apic.show_timing:
+            apic.print_timing(startup, sys.stderr)
+        if commands:
+            if not apic.can_connect:
+                sys.exit(1)
+            failed = False
+            for command in commands:
+                apic.onecmd(apic.precmd(command))
+                failed = failed or apic.failed
+            apic.disconnect()
+            sys.exit(1 if failed else 0)
+        else:
+            apic.cmdloop('Starting ACLI...')
     except KeyboardInterrupt:
         print "\nINFO: ACLI Shell was interrupted by Ctrl-C"
         apic.disconnect()
-
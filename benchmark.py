@@ -0,0 +1,320 @@
+"""
+Benchmarks the ACLI show commands against synthetic fabrics, without an APIC.
+
+A fabric of the requested size (pods, leafs, ports per leaf, EPGs, static paths, vPCs, VLAN pools and port
+selectors) is generated as Record objects and served by MemoryDirectory in place of a Cobra MoDirectory. Every
+command runs in a forked process on a cold cache, so each one reports its own time and peak memory.
+
+    python benchmark.py --sizes small,medium,large
+    python benchmark.py --leafs 250 --ports 48 --epgs 3000 --latency 20 --save baseline.json
+    python benchmark.py --sizes large --baseline baseline.json --tolerance 20
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from collections import OrderedDict
+
+import acli
+from acli import Record, parse_filter, match_filter
+from prettytable import PrettyTable
+
+SIZES = OrderedDict([
+    ('small', {'pods': 1, 'leafs': 10, 'ports': 48, 'epgs': 200, 'paths': 4, 'pools': 5, 'selectors': 4}),
+    ('medium', {'pods': 2, 'leafs': 60, 'ports': 48, 'epgs': 1000, 'paths': 8, 'pools': 20, 'selectors': 8}),
+    ('large', {'pods': 4, 'leafs': 250, 'ports': 48, 'epgs': 3000, 'paths': 16, 'pools': 50, 'selectors': 12}),
+])
+COMMANDS = ['show epg', 'show epg EPG1', 'show interface', 'show interface {leaf}', 'show interface {leaf} 1/1',
+            'show vlan {vlan}', 'show vlan pool', 'show vlan overlap', 'show snapshot']
+TENANTS = 10
+
+
+def generate_fabric(pods, leafs, ports, epgs, paths, pools, selectors):
+    """
+    Returns the Records of a fabric with leafs spread over pods. Leafs are paired into vPC domains, each pair has a
+    switch profile and an interface profile with selectors splitting the ports between access policy groups and
+    vPCs. Each EPG gets paths static bindings, every fourth one to a vPC, with encaps taken from the VLAN pools.
+    """
+    records = []
+    nodes = []
+    for i in range(leafs):
+        pod = i % pods + 1
+        node = 101 + i
+        nodes.append((pod, node))
+        node_dn = 'topology/pod-{0}/node-{1}'.format(pod, node)
+        records.append(Record('fabricNode', node_dn, {'id': str(node), 'role': 'leaf', 'name': 'leaf{0}'.format(node)}))
+        for port in range(1, ports + 1):
+            intf_dn = '{0}/sys/phys-[eth1/{1}]'.format(node_dn, port)
+            records.append(Record('l1PhysIf', intf_dn, {'id': 'eth1/{0}'.format(port), 'portT': 'leaf', 'descr': '',
+                                                        'usage': 'epg' if port % 3 else 'discovery'}))
+            records.append(Record('ethpmPhysIf', intf_dn + '/phys', {'operSt': 'up' if port % 5 else 'down',
+                                                                     'operSpeed': '10G', 'operDuplex': 'full'}))
+
+    pairs = [nodes[i:i + 2] for i in range(0, len(nodes), 2)]
+    ports_per_selector = max(ports // selectors, 1)
+    for pair in pairs:
+        name = '-'.join(str(node) for pod, node in pair)
+        records.append(Record('infraNodeBlk', 'uni/infra/nprof-SW{0}/leaves-L-typ-range/nodeblk-blk'.format(name),
+                              {'from_': str(pair[0][1]), 'to_': str(pair[-1][1])}))
+        profile_dn = 'uni/infra/accportprof-IP{0}'.format(name)
+        records.append(Record('infraRtAccPortP', '{0}/rtaccPortP-[uni/infra/nprof-SW{1}]'.format(profile_dn, name),
+                              {'tDn': 'uni/infra/nprof-SW{0}'.format(name)}))
+        for selector in range(selectors):
+            selector_dn = '{0}/hports-S{1}-typ-range'.format(profile_dn, selector)
+            if selector % 2:
+                policy_group = 'uni/infra/funcprof/accbundle-VPC{0}-{1}'.format(name, selector)
+            else:
+                policy_group = 'uni/infra/funcprof/accportgrp-PG{0}'.format(selector)
+            from_port = selector * ports_per_selector + 1
+            children = [Record('infraRsAccBaseGrp', selector_dn + '/rsaccBaseGrp', {'tDn': policy_group}),
+                        Record('infraPortBlk', selector_dn + '/portblk-block1',
+                               {'fromCard': '1', 'toCard': '1', 'fromPort': str(from_port),
+                                'toPort': str(min(from_port + ports_per_selector - 1, ports))})]
+            records.append(Record('infraHPortS', selector_dn, {'name': 'S{0}'.format(selector)}, children))
+
+    vlans_per_pool = 4000 // max(pools, 1)
+    for pool in range(pools):
+        pool_dn = 'uni/infra/vlanns-[POOL{0}]-static'.format(pool)
+        from_vlan = pool * vlans_per_pool + 1
+        # each pool overlaps the next one by a few VLANs, pairs of pools share a domain for show vlan overlap
+        to_vlan = min(from_vlan + vlans_per_pool + 9, 4094)
+        children = [Record('fvnsEncapBlk', '{0}/from-[vlan-{1}]-to-[vlan-{2}]'.format(pool_dn, from_vlan, to_vlan),
+                           {'from': 'vlan-{0}'.format(from_vlan), 'to': 'vlan-{0}'.format(to_vlan)}),
+                    Record('fvnsRtVlanNs', pool_dn + '/rtinfraVlanNs-[uni/phys-PHY{0}]'.format(pool // 2),
+                           {'tDn': 'uni/phys-PHY{0}'.format(pool // 2)})]
+        records.append(Record('fvnsVlanInstP', pool_dn, {'name': 'POOL{0}'.format(pool), 'allocMode': 'static'},
+                              children))
+
+    for epg in range(epgs):
+        tenant = epg % TENANTS
+        epg_dn = 'uni/tn-T{0}/ap-AP{0}/epg-EPG{1}'.format(tenant, epg)
+        encap = 'vlan-{0}'.format(epg % 4000 + 1)
+        children = [Record('fvRsBd', epg_dn + '/rsbd', {'tnFvBDName': 'BD{0}'.format(epg)}),
+                    Record('tagInst', epg_dn + '/tag-prod', {'name': 'prod'})]
+        for path in range(paths):
+            pair = pairs[(epg + path) % len(pairs)]
+            name = '-'.join(str(node) for pod, node in pair)
+            if path % 4 == 3 and len(pair) == 2 and selectors > 1:
+                t_dn = 'topology/pod-{0}/protpaths-{1}/pathep-[VPC{1}-1]'.format(pair[0][0], name)
+            else:
+                pod, node = pair[path % len(pair)]
+                t_dn = 'topology/pod-{0}/paths-{1}/pathep-[eth1/{2}]'.format(pod, node, (epg + path) % ports + 1)
+            children.append(Record('fvRsPathAtt', '{0}/rspathAtt-[{1}]'.format(epg_dn, t_dn),
+                                   {'tDn': t_dn, 'encap': encap}))
+        records.append(Record('fvAEPg', epg_dn, {'name': 'EPG{0}'.format(epg)}, children))
+
+    for snapshot in range(10):
+        records.append(Record('configSnapshot', 'uni/backupst/snapshots-[uni/fabric/configexp-defaultOneTime]/'
+                                                'file-[ce2_defaultOneTime-{0}.tar.gz]'.format(snapshot),
+                              {'createTime': '2016-01-{0:02d}T00:00:00'.format(snapshot + 1), 'descr': ''}))
+    records.append(Record('aaaModLR', 'subj-[uni/infra]/mod-1', {'id': '1', 'affected': 'uni/infra/funcprof'}))
+    return records
+
+
+class MemoryDirectory(object):
+    """Serves lookups from in-memory Records in place of a MoDirectory, optionally adding APIC latency per query."""
+
+    def __init__(self, records, latency=0):
+        self.latency = latency
+        self.classes = {}
+        self.filters = {}
+        # children are also indexed by class, the APIC answers class queries for them too (i.e. fvRsPathAtt)
+        pending = list(records)
+        while pending:
+            record = pending.pop()
+            self.classes.setdefault(record.meta.moClassName, []).append(record)
+            pending.extend(record.children)
+        for class_records in self.classes.values():
+            class_records.sort(key=lambda record: record.dn)
+
+    def login(self):
+        pass
+
+    def logout(self):
+        pass
+
+    def reauth(self):
+        pass
+
+    def commit(self, request):
+        pass
+
+    def lookupByDn(self, dn, **kwargs):
+        for records in self.classes.values():
+            for record in records:
+                if record.dn == str(dn):
+                    return record
+        return None
+
+    def lookupByClass(self, class_name, parentDn=None, propFilter=None, subtree=None, subtreeClassFilter=None,
+                      pageSize=None, page=0, **kwargs):
+        if self.latency:
+            time.sleep(self.latency)
+        records = self.classes.get(class_name, [])
+        if parentDn:
+            records = [record for record in records if record.dn.startswith(str(parentDn) + '/')]
+        if propFilter:
+            if propFilter not in self.filters:
+                self.filters[propFilter] = parse_filter(propFilter)[0]
+            records = [record for record in records if match_filter(self.filters[propFilter], record)]
+        if pageSize is not None:
+            records = records[int(pageSize) * int(page):int(pageSize) * (int(page) + 1)]
+        if subtree in ('children', 'full'):
+            class_filter = subtreeClassFilter.split(',') if subtreeClassFilter else []
+            records = [Record(record.meta.moClassName, record.dn, record.attributes,
+                              [child for child in record.children
+                               if not class_filter or child.meta.moClassName in class_filter])
+                       for record in records]
+        else:
+            records = [Record(record.meta.moClassName, record.dn, record.attributes) for record in records]
+        return records
+
+
+def connect(directory, name):
+    apic = acli.Apic()
+    apic.md = directory
+    apic.ls = None
+    apic.fabric_name = name
+    apic.engine = acli.QueryEngine(directory, name, apic.cache, timing=apic.timing)
+    apic.load_completions()
+    apic.completions_loaded.wait()
+    apic.can_connect = name
+    return apic
+
+
+def max_rss_mb(rusage):
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return rusage.ru_maxrss / (1024.0 * 1024 if sys.platform == 'darwin' else 1024.0)
+
+
+def run_forked(func):
+    """Runs func in a child process, returns its JSON serialisable result and the child's peak memory in MB"""
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, 1)
+        try:
+            result = func()
+        except Exception as error:
+            result = {'error': str(error)}
+        os.write(write_fd, json.dumps(result))
+        os._exit(0)
+    os.close(write_fd)
+    output = ''
+    while True:
+        data = os.read(read_fd, 65536)
+        if not data:
+            break
+        output += data
+    os.close(read_fd)
+    rusage = os.wait4(pid, 0)[2]
+    return json.loads(output), max_rss_mb(rusage)
+
+
+def measure(directory, name, command, repeat):
+    """Runs command repeat times on a fresh session and cold cache, returns the fastest run"""
+    def run():
+        runs = []
+        for i in range(repeat):
+            apic = connect(directory, name)
+            # the leafs queried for the completions at login are not in the cache of a command either
+            apic.cache.invalidate()
+            start = time.time()
+            apic.onecmd(apic.precmd(command))
+            duration = time.time() - start
+            spans = apic.timing.commands[-1]['spans']
+            runs.append({'ms': duration * 1000,
+                         'render_ms': sum(span['duration'] for span in spans if span['category'] == 'render') * 1000,
+                         'queries': len([span for span in spans if span['category'] == 'query'])})
+        return min(runs, key=lambda run: run['ms'])
+    return run_forked(run)
+
+
+def benchmark(sizes, latency, repeat):
+    results = []
+    for size_name, size in sizes.items():
+        records = generate_fabric(**size)
+        directory = MemoryDirectory(records, latency)
+        baseline_mb = run_forked(lambda: {})[1]
+        leaf = str(101 + size['leafs'] - 1)
+        # a VLAN in the overlap of the first two pools
+        vlan = 4000 // max(size['pools'], 1) + 5
+        for command in COMMANDS:
+            command = command.format(leaf=leaf, vlan=vlan)
+            result, peak_mb = measure(directory, 'benchmark-' + size_name, command, repeat)
+            if 'error' in result:
+                print >> sys.stderr, 'ERROR:', size_name, command, result['error']
+                continue
+            result.update({'size': size_name, 'command': command, 'mos': len(records), 'peak_mb': peak_mb,
+                           'memory_mb': peak_mb - baseline_mb})
+            results.append(result)
+            print >> sys.stderr, size_name, command, int(result['ms']), 'ms'
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Marks the results which are slower or use more memory than the baseline by more than tolerance percent"""
+    previous = dict(((item['size'], item['command']), item) for item in baseline)
+    regressions = 0
+    for result in results:
+        result['regression'] = ''
+        before = previous.get((result['size'], result['command']))
+        if before is None:
+            continue
+        # differences below 10 ms or 1 MB are noise
+        for field, label, noise in (('ms', 'time', 10), ('memory_mb', 'memory', 1)):
+            if result[field] > before[field] * (1 + tolerance / 100.0) and result[field] - before[field] > noise:
+                increase = (result[field] / max(before[field], 0.001) - 1) * 100
+                result['regression'] += '{0} +{1:.0f}% '.format(label, increase)
+        if result['regression']:
+            regressions += 1
+    return regressions
+
+
+def print_results(results):
+    y = PrettyTable(['SIZE', 'MOS', 'COMMAND', 'QUERIES', 'MS', 'RENDER MS', 'PEAK MB', 'MEMORY MB', 'REGRESSION'])
+    y.align = 'l'
+    for result in results:
+        y.add_row([result['size'], result['mos'], result['command'], result['queries'], int(result['ms']),
+                   int(result['render_ms']), '{0:.1f}'.format(result['peak_mb']), '{0:.1f}'.format(result['memory_mb']),
+                   result.get('regression', '')])
+    print y
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks ACLI show commands against synthetic fabrics')
+    parser.add_argument('--sizes', default='small,medium', help='comma separated presets: ' + ', '.join(SIZES))
+    for option in ('pods', 'leafs', 'ports', 'epgs', 'paths', 'pools', 'selectors'):
+        parser.add_argument('--' + option, type=int, help='custom fabric size, overrides --sizes')
+    parser.add_argument('--latency', type=float, default=0, help='milliseconds added to every query, like an APIC')
+    parser.add_argument('--repeat', type=int, default=1, help='runs per command, the fastest is reported')
+    parser.add_argument('--save', help='save the results as JSON, to compare later runs with')
+    parser.add_argument('--baseline', help='compare with results saved by --save')
+    parser.add_argument('--tolerance', type=float, default=20, help='percent slower than baseline to flag, default 20')
+    options = parser.parse_args()
+
+    custom = dict((option, getattr(options, option)) for option in SIZES['small']
+                  if getattr(options, option) is not None)
+    if custom:
+        sizes = OrderedDict([('custom', dict(SIZES['small'], **custom))])
+    else:
+        unknown = [name for name in options.sizes.split(',') if name not in SIZES]
+        if unknown:
+            sys.exit('ERROR: unknown size ' + ', '.join(unknown))
+        sizes = OrderedDict((name, SIZES[name]) for name in options.sizes.split(','))
+
+    results = benchmark(sizes, options.latency / 1000.0, options.repeat)
+    regressions = 0
+    if options.baseline:
+        with open(options.baseline) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), options.tolerance)
+    print_results(results)
+    if options.save:
+        with open(options.save, 'w') as save_file:
+            json.dump(results, save_file, indent=1)
+    if regressions:
+        sys.exit('{0} commands regressed'.format(regressions))
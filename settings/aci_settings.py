@@ -12,3 +12,26 @@ FABRICS = {'F1': [
     {'address': 'sandboxapicdc.cisco.com', 'username': 'admin', 'password': ''},
      ],
 }
+
+# Maximum number of queries sent to an APIC at the same time
+QUERY_CONCURRENCY = 4
+
+# Seconds to keep query results in the local cache, per APIC class (0 disables caching for the class)
+# CACHE_TTL = {'infraHPortS': 600, 'ethpmPhysIf': 10}
+# Upper bound on the number of objects kept in the cache
+# CACHE_MAX_MOS = 500000
+
+# Number of objects per page when walking large classes (fvAEPg, l1PhysIf, ethpmPhysIf)
+PAGE_SIZE = 5000
+
+# Seconds to wait for an APIC to answer before failing over to the next fastest one
+APIC_TIMEOUT = 30
+
+# Show commands read from the APIC REST API directly instead of building Cobra objects, set to False to read through Cobra
+REST_READS = True
+
+# Directory the completion names are saved in per fabric, so a login doesn't download them again
+# COMPLETIONS_DIR = '~/.acli'
+
+# Unix socket the daemon (acli.py --serve) listens on
+# DAEMON_SOCKET = '~/.acli/acli.sock'